@@ -4,7 +4,8 @@ import os
 from django.views.decorators.csrf import csrf_exempt
 from django.http import (
     HttpResponse,
-    HttpResponseServerError
+    HttpResponseServerError,
+    StreamingHttpResponse,
 )
 from django.conf import settings
 from django.utils.encoding import iri_to_uri
@@ -17,6 +18,8 @@ from license_protected_downloads.models import (
 from license_protected_downloads.common import (
     dir_list,
     find_artifact,
+    iter_dir_list,
+    listing_marker,
     safe_path_join,
 )
 
@@ -88,25 +91,57 @@ def file_server_post(request, path):
     return HttpResponse("OK")
 
 
+def _api_listing_entry(entry):
+    return {
+        "name": entry.name,
+        "size": entry.size,
+        "type": entry.type,
+        "mtime": entry.mtime,
+        "url": entry.url,
+    }
+
+
+def _stream_listing(entries, limit):
+    yield '{"files": ['
+    count = 0
+    last = None
+    for entry in entries:
+        if count == limit:
+            yield '], "next_marker": %s}' % json.dumps(listing_marker(last))
+            return
+        if count:
+            yield ', '
+        yield json.dumps(_api_listing_entry(entry))
+        count += 1
+        last = entry
+    yield ']}'
+
+
 def list_files_api(request, path):
     path = iri_to_uri(path)
     artifact = find_artifact(request, path)
 
+    stream = ('stream', 'limit', 'marker')
+    if artifact.isdir() and any(x in request.GET for x in stream):
+        limit = request.GET.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError(limit)
+            except ValueError:
+                return HttpResponse('Invalid limit', status=400)
+        entries = iter_dir_list(
+            artifact, False, request.GET.get('marker') or None)
+        return StreamingHttpResponse(
+            _stream_listing(entries, limit), content_type='application/json')
+
     if artifact.isdir():
         listing = dir_list(artifact, human_readable=False)
     else:
         listing = [artifact.get_listing()]
 
-    clean_listing = []
-    for entry in listing:
-        clean_listing.append({
-            "name": entry["name"],
-            "size": entry["size"],
-            "type": entry["type"],
-            "mtime": entry["mtime"],
-            "url": entry["url"],
-        })
-
+    clean_listing = [_api_listing_entry(x) for x in listing]
     data = json.dumps({"files": clean_listing})
     return HttpResponse(data, content_type='application/json')
 
@@ -4,7 +4,11 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from license_protected_downloads.artifact.s3 import S3Artifact
+from license_protected_downloads.artifact.s3 import (
+    S3Artifact,
+    invalidate_link,
+    invalidate_listings,
+)
 from license_protected_downloads.api.v1 import (
     HttpResponseError,
 )
@@ -40,6 +44,9 @@ class PublishResource(v2.PublishResource):
 
         resp = HttpResponse(status=201)
         resp['Location'] = k.generate_url(60, method='PUT', headers=headers)
+        # the upload goes straight to S3, so this is our only chance to
+        # drop listings that won't include the new file
+        invalidate_listings(k.name)
         APILog.mark(self.request, 'FILE_UPLOAD', self.api_key)
         return resp
 
@@ -75,10 +82,12 @@ class LatestLinkResource(PublishResource):
             raise HttpResponseError('Invalid link name', 401)
 
         dst = os.path.join(os.path.dirname(path), link_name)
-        keys = b.list(dst)
+        keys = list(b.list(dst))
         b.delete_keys(keys)
         # keep track of where the link content came from
         b.new_key(dst + '/.s3_linked_from').set_contents_from_string(path)
+        invalidate_listings(dst + '/.s3_linked_from', *[x.name for x in keys])
+        invalidate_link(dst + '/.s3_linked_from')
 
         APILog.mark(self.request, 'LINK_LATEST', self.api_key)
 
@@ -3,19 +3,66 @@ import hashlib
 import logging
 import os
 import re
+import threading
+import time
 import traceback
+from HTMLParser import HTMLParser, HTMLParseError
 
 from BeautifulSoup import BeautifulSoup
 from django.conf import settings
+from django.utils.encoding import force_bytes
 
 from license_protected_downloads import(
     buildinfo,
     models,
 )
+from license_protected_downloads.lru import LRUCache
 from license_protected_downloads.render_text_files import RenderTextFiles
 
 log = logging.getLogger("llp.views")
 
+# seconds a theme license text is trusted before its mtime is checked again
+THEME_LICENSE_CHECK_INTERVAL = 30
+
+# number of HEADER.html fragments to remember
+HEADERS_SIZE = 256
+
+
+HIDDEN_FILES = ["BUILD-INFO.txt", "EULA.txt", "HEADER.html",
+                "HEADER.textile", "HOWTO_", "textile", ".htaccess",
+                "licenses", ".s3_linked_from"]
+
+
+def is_hidden(file_name):
+    for pattern in HIDDEN_FILES:
+        if re.search(pattern, file_name):
+            return True
+    return False
+
+
+def humanize(size, mtime):
+    '''Return size and mtime formatted for showing in a listing.'''
+    size = _sizeof_fmt(size)
+    if type(mtime) == float:
+        mtime = datetime.datetime.fromtimestamp(mtime)
+        mtime = mtime.strftime('%d-%b-%Y %H:%M')
+    return size, mtime
+
+
+def join_url(urlbase, file_name, isdir):
+    url = urlbase
+    if url:
+        if url[0] != '/':
+            url = '/' + url
+        if url[-1] != '/':
+            url += '/'
+    else:
+        url = '/'
+    url = url + file_name
+    if isdir and url[-1] != '/':
+        url += '/'
+    return url
+
 
 def _sizeof_fmt(num):
     ''' Returns in human readable format for num.
@@ -41,10 +88,187 @@ def cached_prop(fn):
     return _cached_prop
 
 
-def _insert_license_into_db(digest, text, theme):
-    if not models.License.objects.filter(digest=digest):
-        l = models.License(digest=digest, text=text, theme=theme)
-        l.save()
+class _ThemeLicenses(object):
+    '''The texts of templates/licenses/<theme>.txt kept in memory.
+
+    A file is stat'ed at most once every THEME_LICENSE_CHECK_INTERVAL
+    seconds and only read again when its mtime changes.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._texts = {}
+
+    def get(self, theme):
+        path = os.path.join(
+            settings.PROJECT_ROOT, 'templates/licenses/' + theme + '.txt')
+        now = time.time()
+        with self._lock:
+            entry = self._texts.get(path)
+        if entry and now - entry[1] < THEME_LICENSE_CHECK_INTERVAL:
+            return entry[2]
+
+        mtime = os.stat(path).st_mtime
+        if entry and entry[0] == mtime:
+            text = entry[2]
+        else:
+            with open(path) as f:
+                text = f.read()
+        with self._lock:
+            self._texts[path] = (mtime, now, text)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._texts.clear()
+
+
+theme_licenses = _ThemeLicenses()
+
+
+class ListingEntry(object):
+    '''One row of a directory listing.
+
+    Listings can have tens of thousands of rows, so they are kept as small
+    records rather than artifacts or dicts. Item access is supported for
+    code and templates that treat rows as dicts.
+    '''
+    __slots__ = ('name', 'size', 'mtime', 'type', 'url',
+                 'license_digest_list', 'license_list')
+
+    def __init__(self, name, size, mtime, type, url,
+                 license_digest_list=None, license_list=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.type = type
+        self.url = url
+        self.license_digest_list = license_digest_list
+        self.license_list = license_list
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<ListingEntry: %s>' % self.url
+
+    @property
+    def file_name(self):
+        return self.name
+
+    def isdir(self):
+        return self.type == 'folder'
+
+    def hidden(self):
+        return is_hidden(self.name)
+
+
+def license_list(license_digest_list, licenses):
+    '''Return the License objects for a license_digest_list.
+
+    licenses is a dict of digest to License as returned by
+    License.objects.by_digest().
+    '''
+    if not isinstance(license_digest_list, list):
+        # OPEN or INVALID
+        return []
+    ll = []
+    for x in license_digest_list:
+        lic = licenses.get(x)
+        if lic is not None and lic not in ll:
+            ll.append(lic)
+    return ll
+
+
+def safe_license_digests(url, func, *args):
+    '''Call a license digest function, returning INVALID if it fails.'''
+    try:
+        return func(*args)
+    except Exception as e:
+        print("Invalid BUILD-INFO.txt for %s: %s" % (url, repr(e)))
+        traceback.print_exc()
+        return "INVALID"
+
+
+class _ContentExtractor(HTMLParser):
+    '''Find the contents of the elements with id="content".
+
+    Only the offsets of the blocks are recorded, the markup inside them is
+    returned as is. Like BeautifulSoup, an element that isn't closed ends
+    with its body.
+    '''
+    def __init__(self, body):
+        HTMLParser.__init__(self)
+        self.body = body
+        # getpos() only counts '\n' as a line break, unlike splitlines()
+        self.lines = [0]
+        for line in body.split('\n'):
+            self.lines.append(self.lines[-1] + len(line) + 1)
+        self.blocks = []
+        self.tag = None  # of the element being extracted
+        self.depth = 0
+        self.start = None
+
+    def _offset(self):
+        line, col = self.getpos()
+        return self.lines[line - 1] + col
+
+    def _close(self, end):
+        self.blocks.append(self.body[self.start:end])
+        self.tag = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.tag is None:
+            if ('id', 'content') in attrs:
+                self.tag = tag
+                self.depth = 1
+                self.start = self._offset() + len(self.get_starttag_text())
+        elif tag == self.tag:
+            self.depth += 1
+
+    def handle_endtag(self, tag):
+        if self.tag is None:
+            return
+        if tag == self.tag:
+            self.depth -= 1
+            if self.depth == 0:
+                self._close(self._offset())
+        elif tag in ('body', 'html'):
+            self._close(self._offset())
+
+    def extract(self):
+        self.feed(self.body)
+        self.close()
+        if self.tag is not None:
+            self._close(len(self.body))
+        return ''.join(self.blocks)
+
+
+def _decode(body):
+    if isinstance(body, unicode):
+        return body
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body.decode('windows-1252', 'replace')
+
+
+def extract_content(body):
+    '''Return what's inside the id="content" elements of an html page.'''
+    body = _decode(body)
+    try:
+        return _ContentExtractor(body).extract().strip()
+    except HTMLParseError:
+        # too broken for HTMLParser, BeautifulSoup copes with anything
+        content = ''
+        for chunk in BeautifulSoup(body).findAll(id='content'):
+            content += chunk.prettify().decode('utf-8')
+        return '\n'.join(content.split('\n')[1:-1])
+
+
+_headers = LRUCache(HEADERS_SIZE)
 
 
 class Artifact(object):
@@ -61,36 +285,16 @@ class Artifact(object):
         self.human_readable = human_readable
 
         if human_readable:
-            self.size = _sizeof_fmt(size)
-            if type(mtime) == float:
-                mtime = datetime.datetime.fromtimestamp(mtime)
-                self.mtime = mtime.strftime('%d-%b-%Y %H:%M')
+            self.size, self.mtime = humanize(size, mtime)
 
     def isdir(self):
         raise RuntimeError()
 
     def hidden(self):
-        hidden_files = ["BUILD-INFO.txt", "EULA.txt", "HEADER.html",
-                        "HEADER.textile", "HOWTO_", "textile", ".htaccess",
-                        "licenses", ".s3_linked_from"]
-        for pattern in hidden_files:
-            if re.search(pattern, self.file_name):
-                return True
-        return False
+        return is_hidden(self.file_name)
 
     def url(self):
-        url = self.urlbase
-        if url:
-            if url[0] != '/':
-                url = '/' + url
-            if url[-1] != '/':
-                url += '/'
-        else:
-            url = '/'
-        url = url + self.file_name
-        if self.isdir() and url[-1] != '/':
-            url += '/'
-        return url
+        return join_url(self.urlbase, self.file_name, self.isdir())
 
     def get_type(self):
         raise NotImplementedError()
@@ -107,6 +311,10 @@ class Artifact(object):
     def get_real_name(self):
         raise NotImplementedError()
 
+    def prefetch(self):
+        '''Fetch ahead what rendering this directory will need.'''
+        pass
+
     def get_build_info(self):
         buf = self.build_info_buffer
         if buf:
@@ -114,30 +322,34 @@ class Artifact(object):
             # will get license-digests for *all* files iff you pass no
             # file-name to its constructor
             if self.isdir():
-                return buildinfo.BuildInfoBase('', buf)
-            return buildinfo.BuildInfoBase(self.file_name, buf)
+                return buildinfo.from_buffer('', buf)
+            return buildinfo.from_buffer(self.file_name, buf)
 
-    def get_listing(self):
+    @cached_prop
+    def license_digest_list(self):
         if self.isdir():
-            ldl = []
+            return []
+        return safe_license_digests(self.url, self.get_license_digests)
+
+    def listing_entry(self):
+        """Return the ListingEntry for this artifact without its licenses."""
+        return ListingEntry(self.file_name, self.size, self.mtime,
+                            self.get_type(), self.url())
+
+    def get_listing(self, licenses=None):
+        """Return the ListingEntry describing this artifact in a listing.
+
+        licenses can be a dict of digest to License as returned by
+        License.objects.by_digest(). It saves a query per artifact when
+        listing a whole directory.
+        """
+        entry = self.listing_entry()
+        ldl = entry.license_digest_list = self.license_digest_list
+        if licenses is None:
+            entry.license_list = models.License.objects.all_with_hashes(ldl)
         else:
-            try:
-                ldl = self.get_license_digests()
-            except Exception as e:
-                print("Invalid BUILD-INFO.txt for %s: %s" % (
-                    self.url, repr(e)))
-                traceback.print_exc()
-                ldl = "INVALID"
-        ll = models.License.objects.all_with_hashes(ldl)
-        return {
-            'name': self.file_name,
-            'size': self.size,
-            'mtime': self.mtime,
-            'license_digest_list': ldl,
-            'license_list': ll,
-            'type': self.get_type(),
-            'url': self.url(),
-        }
+            entry.license_list = license_list(ldl, licenses)
+        return entry
 
     def get_digest(self, lic_type, lic_text, theme, auth_groups):
         if lic_type == 'open' or (auth_groups and not lic_text):
@@ -148,9 +360,7 @@ class Artifact(object):
                      'BUILD-INFO file.')
             return
 
-        digest = hashlib.md5(lic_text).hexdigest()
-        _insert_license_into_db(digest, lic_text, theme)
-        return digest
+        return models.license_registry.register(lic_text, theme)
 
     def get_build_info_digests(self, bi):
         digests = []
@@ -167,39 +377,50 @@ class Artifact(object):
                 digests.append(d)
         return digests
 
-    def get_eula_digests(self):
-        path = self.urlbase + self.file_name
+    def get_eula_digests(self, path=None):
+        if path is None:
+            path = self.urlbase + self.file_name
         theme = 'linaro'
         if 'snowball' in path:
             theme = 'stericsson'
         elif 'origen' in path:
             theme = 'samsung'
         lic_type = 'protected'
-        lic_file = os.path.join(
-            settings.PROJECT_ROOT, 'templates/licenses/' + theme + '.txt')
-        with open(lic_file) as f:
-            lic_txt = f.read()
-            return [self.get_digest(lic_type, lic_txt, theme, None)]
+        lic_txt = theme_licenses.get(theme)
+        return [self.get_digest(lic_type, lic_txt, theme, None)]
 
     def get_license_digests(self):
         bi = self.get_build_info()
         if bi:
             return self.get_build_info_digests(bi)
+        return self.get_eula_license_digests(
+            self.get_eulas(), self.file_name, self.urlbase + self.file_name)
 
-        eulas = self.get_eulas()
+    def get_child_license_digests(self, file_name, eulas):
+        """Return the license digests of a file in this directory.
 
+        This gives the same result as get_license_digests() on the file's
+        own artifact, so listings don't need to create one. eulas is
+        self.get_eulas(), which callers can share between files.
+        """
+        assert self.isdir()
+        buf = self.build_info_buffer
+        if buf:
+            bi = buildinfo.from_buffer(file_name, buf)
+            return self.get_build_info_digests(bi)
+        return self.get_eula_license_digests(
+            eulas, file_name, self.url() + file_name)
+
+    def get_eula_license_digests(self, eulas, file_name, path):
         if self.has_open_eula(eulas):
             return 'OPEN'
 
         if self.has_eula(eulas):
-            return self.get_eula_digests()
+            return self.get_eula_digests(path)
 
-        theme = self.get_eula_per_file_theme(eulas)
+        theme = self.get_eula_per_file_theme(eulas, file_name)
         if theme:
-            lic_file = os.path.join(settings.PROJECT_ROOT,
-                                    'templates/licenses/' + theme + '.txt')
-            with open(lic_file) as f:
-                lic_txt = f.read()
+            lic_txt = theme_licenses.get(theme)
             return [self.get_digest('protected', lic_txt, theme, None)]
 
         if self.has_per_file_eulas(eulas):
@@ -217,8 +438,10 @@ class Artifact(object):
             if x == 'EULA.txt':
                 return True
 
-    def get_eula_per_file_theme(self, eulas):
-        eula_pat = os.path.basename(self.file_name) + '.EULA.txt'
+    def get_eula_per_file_theme(self, eulas, file_name=None):
+        if file_name is None:
+            file_name = self.file_name
+        eula_pat = os.path.basename(file_name) + '.EULA.txt'
         for x in eulas:
             if eula_pat in x:
                 vendor = os.path.splitext(x)[1]
@@ -261,12 +484,13 @@ class Artifact(object):
 
         body = self.get_file_contents('HEADER.html')
         if body:
+            # the digest covers the included files along with the header
             body = self._process_include_tags(body)
-            soup = BeautifulSoup(body)
-            for chunk in soup.findAll(id='content'):
-                content += chunk.prettify().decode('utf-8')
-
-            content = '\n'.join(content.split('\n')[1:-1])
+            key = hashlib.md5(force_bytes(body)).hexdigest()
+            content = _headers.get(key)
+            if content is None:
+                content = extract_content(body)
+                _headers.set(key, content)
         return content
 
     def get_annotated_manifest(self):
@@ -1,45 +1,87 @@
-import glob
 import mimetypes
 import os
+import stat
 
 from django.http import HttpResponse
 from django.utils.encoding import smart_str
 
 from license_protected_downloads import(
-    buildinfo,
+    dir_index,
     render_text_files,
 )
 from license_protected_downloads.artifact.base import (
     Artifact,
+    ListingEntry,
     cached_prop,
+    humanize,
+    join_url,
 )
 
 
+def _get_type(path, isdir, human_readable):
+    if isdir:
+        return 'folder'
+    mtype = mimetypes.guess_type(path)[0]
+    if human_readable:
+        if mtype is None:
+            mtype = 'other'
+        elif mtype.split('/')[0] == 'text':
+            mtype = 'text'
+    return mtype
+
+
 class LocalArtifact(Artifact):
     '''An artifact that lives on the local filesystem'''
-    def __init__(self, parent, urlbase, file_name, human_readable, path):
+    def __init__(self, parent, urlbase, file_name, human_readable, path,
+                 st=None):
         self.parent = parent
         self.full_path = os.path.join(path, file_name)
 
+        if st is None:
+            try:
+                st = os.stat(self.full_path)
+            except OSError:
+                # doesn't exist or is a broken symlink
+                pass
+
         size = mtime = 0
-        # ensure the file we are looking at exists (not broken symlink)
-        if os.path.exists(self.full_path):
-            size = os.path.getsize(self.full_path)
-            mtime = os.path.getmtime(self.full_path)
+        self._isdir = False
+        if st is not None:
+            size = st.st_size
+            mtime = st.st_mtime
+            self._isdir = stat.S_ISDIR(st.st_mode)
         super(LocalArtifact, self).__init__(
             urlbase, file_name, size, mtime, human_readable)
 
+    def list_entries(self, human_readable):
+        '''Return a ListingEntry for each file in this directory.
+
+        No artifacts are created for the files. The license fields of the
+        entries are left for the caller to fill in, see
+        get_child_license_digests().
+        '''
+        assert self.isdir()
+        url = self.url()
+        entries = []
+        index = dir_index.get(self.full_path)
+        for name in (index.names if index else []):
+            path = os.path.join(self.full_path, name)
+            size = mtime = 0
+            isdir = False
+            st = index.stat(name)
+            if st is not None:
+                size = st.st_size
+                mtime = st.st_mtime
+                isdir = stat.S_ISDIR(st.st_mode)
+            if human_readable:
+                size, mtime = humanize(size, mtime)
+            entries.append(ListingEntry(
+                name, size, mtime, _get_type(path, isdir, human_readable),
+                join_url(url, name, isdir)))
+        return entries
+
     def get_type(self):
-        if self.isdir():
-            return 'folder'
-        else:
-            mtype = mimetypes.guess_type(self.full_path)[0]
-            if self.human_readable:
-                if mtype is None:
-                    mtype = 'other'
-                elif mtype.split('/')[0] == 'text':
-                    mtype = 'text'
-            return mtype
+        return _get_type(self.full_path, self.isdir(), self.human_readable)
 
     def get_file_download_response(self, method='GET', force_http=False):
         "Return HttpResponse which will send path to user's browser."
@@ -59,19 +101,22 @@ class LocalArtifact(Artifact):
         if self.parent and not self.isdir():
             return self.parent.build_info_buffer
 
-        p = buildinfo.BuildInfo.get_search_path(self.full_path)
-        p = os.path.join(p, 'BUILD-INFO.txt')
-        if os.path.exists(p):
-            with open(p) as f:
+        path = self._search_path()
+        index = dir_index.get(path)
+        if index and index.exists('BUILD-INFO.txt'):
+            with open(os.path.join(path, 'BUILD-INFO.txt')) as f:
                 return f.read()
 
-    def get_eulas(self):
+    def _search_path(self):
         if self.isdir():
-            path = self.full_path
-        else:
-            path = os.path.dirname(self.full_path)
-        eulas = glob.glob(path + '/*EULA.txt*')
-        return [os.path.basename(x) for x in eulas]
+            return self.full_path
+        return os.path.dirname(self.full_path)
+
+    def get_eulas(self):
+        index = dir_index.get(self._search_path())
+        if index is None:
+            return []
+        return list(index.eulas)
 
     def get_file_contents(self, fname):
         fname = os.path.join(self.full_path, fname)
@@ -88,7 +133,7 @@ class LocalArtifact(Artifact):
                 yield f, fd
 
     def isdir(self):
-        return os.path.isdir(self.full_path)
+        return self._isdir
 
     def get_real_name(self):
         base_len = len(self.full_path) - len(self.file_name)
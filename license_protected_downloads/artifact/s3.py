@@ -1,33 +1,217 @@
 import datetime
+import hashlib
+import logging
 import mimetypes
 import os
+import threading
 import time
+import uuid
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 import boto
+import boto.exception
 import boto.s3.key
+import boto.s3.prefix
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponseRedirect
+from django.utils.encoding import force_bytes
 
+from license_protected_downloads import s3_connection, wildcard
+from license_protected_downloads.lru import LRUCache
 from license_protected_downloads.artifact.base import (
     Artifact,
     cached_prop,
 )
 
+log = logging.getLogger("llp.s3")
+
+# number of .s3_linked_from files to remember in each process
+LATEST_LINKS_SIZE = 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    '''Return the thread pool used to prefetch from S3.
+
+    It's created on first use so that it isn't inherited across a fork.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.S3_PREFETCH_THREADS)
+        return _pool
+
+
+def _listing_cache_key(prefix):
+    # prefixes can contain characters memcached won't accept in a key
+    return 's3-listing:' + hashlib.md5(force_bytes(prefix)).hexdigest()
+
+
+def _listing_item(bucket, entry):
+    name, size, last_modified, etag = entry
+    if size is None:
+        return boto.s3.prefix.Prefix(bucket, name)
+    item = boto.s3.key.Key(bucket, name)
+    item.size = size
+    item.last_modified = last_modified
+    item.etag = etag
+    return item
+
+
+def _list_entries_item(item):
+    if isinstance(item, boto.s3.prefix.Prefix):
+        return (item.name, None, None, None)
+    return (item.name, item.size, item.last_modified, item.etag)
+
+
+def _list_entries(bucket, prefix):
+    return [_list_entries_item(x)
+            for x in bucket.list(delimiter='/', prefix=prefix)]
+
+
+def _listing_entries(bucket, prefix):
+    key = _listing_cache_key(prefix)
+    entries = cache.get(key)
+    if entries is None:
+        entries = s3_connection.retry(_list_entries, bucket, prefix)
+        if len(entries) <= settings.S3_LISTING_CACHE_MAX_ITEMS:
+            cache.set(key, entries, settings.S3_LISTING_CACHE_TIMEOUT)
+    return entries
+
+
+def list_prefix(bucket, prefix):
+    '''Return the keys and sub-directory prefixes S3 has under prefix.
+
+    This is bucket.list(delimiter='/', prefix=prefix), but the result is kept
+    in the django cache so hot directories can be listed without going to S3.
+    Only the attributes we use are cached, and fresh boto objects are handed
+    out on each call since S3Artifact modifies the items it is given.
+    '''
+    return [_listing_item(bucket, x) for x in _listing_entries(bucket, prefix)]
+
+
+def _version_cache_key(prefix):
+    return 's3-version:' + hashlib.md5(force_bytes(prefix)).hexdigest()
+
+
+def _prefix_version(prefix):
+    '''Return a token that changes when a key is added under prefix.
+
+    invalidate_listings() deletes the token, so a new one is made here. The
+    same happens if the cache evicts it.
+    '''
+    key = _version_cache_key(prefix)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def _match_entries(bucket, prefix, pattern, limit):
+    literal = wildcard.literal_prefix(pattern)
+    items = bucket.list(delimiter='/', prefix=prefix + literal)
+    found = wildcard.first_matches(
+        items, pattern, limit, key=lambda x: os.path.basename(x.name))
+    return [_list_entries_item(x) for x in found]
+
+
+def match_prefix(bucket, prefix, pattern, limit=2):
+    '''Return up to limit items directly under prefix matching pattern.
+
+    Only the keys starting with the pattern's literal prefix are listed, and
+    the listing stops once limit matches are found. The result is kept in
+    the django cache until invalidate_listings() is told about a new key
+    under prefix.
+    '''
+    key = 's3-match:' + hashlib.md5(force_bytes('%s\0%s\0%d\0%s' % (
+        prefix, pattern, limit, _prefix_version(prefix)))).hexdigest()
+    entries = cache.get(key)
+    if entries is None:
+        entries = s3_connection.retry(
+            _match_entries, bucket, prefix, pattern, limit)
+        cache.set(key, entries, settings.S3_LISTING_CACHE_TIMEOUT)
+    return [_listing_item(bucket, x) for x in entries]
+
+
+def invalidate_listings(*names):
+    '''Drop cached listings that could include the given key names.
+
+    A new key can create new "directories" all the way up the tree, so the
+    listing of every parent is dropped along with the key's own prefix.
+    '''
+    prefixes = set()
+    for name in names:
+        name = name.rstrip('/')
+        while name:
+            prefixes.update([name, name + '/'])
+            name = os.path.dirname(name)
+    cache.delete_many([_listing_cache_key(x) for x in prefixes] +
+                      [_version_cache_key(x) for x in prefixes])
+
+
+_links = LRUCache(LATEST_LINKS_SIZE)
+
+
+def _link_cache_key(name):
+    return 's3-link:' + hashlib.md5(force_bytes(name)).hexdigest()
+
+
+def read_link(bucket, name):
+    '''Return the contents of the .s3_linked_from key called name.
+
+    These are read on most requests for "latest" paths, so the contents are
+    kept in memory and in the django cache. A link that doesn't exist is
+    remembered as an empty string. None is returned if S3 can't be read.
+    '''
+    now = time.time()
+    entry = _links.get(name)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    cache_key = _link_cache_key(name)
+    target = cache.get(cache_key)
+    if target is None:
+        key = boto.s3.key.Key(bucket, name)
+        try:
+            target = s3_connection.retry(key.get_contents_as_string).strip()
+        except boto.exception.S3ResponseError as e:
+            if e.status != 404:
+                log.exception('Unable to read %s', name)
+                return None
+            target = ''
+        except Exception:
+            log.exception('Unable to read %s', name)
+            return None
+        cache.set(cache_key, target, settings.LATEST_LINK_CACHE_TIMEOUT)
+    _links.set(name, (target, now + settings.LATEST_LINK_LOCAL_TIMEOUT))
+    return target
+
+
+def invalidate_link(name):
+    '''Forget the contents of the .s3_linked_from key called name.
+
+    Other processes keep what they read for up to LATEST_LINK_LOCAL_TIMEOUT
+    seconds.
+    '''
+    for x in set([name, S3Artifact.pathname2url(name)]):
+        _links.delete(x)
+        cache.delete(_link_cache_key(x))
+
 
 class S3Artifact(Artifact):
     bucket = None
 
     @classmethod
     def get_bucket(cls):
-        '''Keeps a single bucket object cached for the duration of a request'''
-        if not cls.bucket:
-            b = getattr(settings, 'S3_BUCKET', None)
-            if b:
-                c = boto.connect_s3(
-                    settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
-                cls.bucket = c.get_bucket(settings.S3_BUCKET)
-        return cls.bucket
+        '''Return the S3_BUCKET bucket on the current thread's connection'''
+        return s3_connection.get_bucket()
 
     @staticmethod
     def pathname2url(path):
@@ -72,6 +256,23 @@ class S3Artifact(Artifact):
         super(S3Artifact, self).__init__(
             base, file_name, item.size, item.last_modified, human_readable)
 
+    def __getstate__(self):
+        # artifacts get pickled into the django cache, but the bucket holds
+        # a live connection. Reattach to our own bucket when unpickled.
+        state = self.__dict__.copy()
+        state['bucket'] = None
+        state.pop('_prefetched', None)
+        state.pop('_prefetched_listing', None)
+        if 'item' in state:
+            state['item'] = state['item'].name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bucket = self.get_bucket()
+        if 'item' in state:
+            self.item = boto.s3.key.Key(self.bucket, state['item'])
+
     def get_type(self):
         if self.human_readable:
             if self.mtype is None:
@@ -99,18 +300,9 @@ class S3Artifact(Artifact):
         if self.isdir():
             key += '/' + self.file_name
         key += '/BUILD-INFO.txt'
+        return self._read_key(key)
 
-        try:
-            key = boto.s3.key.Key(self.bucket, key)
-            return key.get_contents_as_string()
-        except boto.exception.S3ResponseError:
-            pass  # No build-info file, return None - its okay
-
-    @cached_prop
-    def _container_eulas(self):
-        if not self.isdir() and self.parent:
-            return self.parent._container_eulas
-
+    def _listing_prefix(self):
         prefix = settings.S3_PREFIX_PATH + self.urlbase[1:]
         if prefix[-1] != '/':
             # s3 listing needs '/' to do a dir listing
@@ -118,12 +310,87 @@ class S3Artifact(Artifact):
 
         if self.isdir():
             prefix += self.file_name + '/'
+        return prefix
+
+    def listing(self, prefix):
+        '''Return list_prefix(self.bucket, prefix).
+
+        The listing prefetch() made is used if it is of the same prefix.
+        '''
+        listing = getattr(self, '_prefetched_listing', None)
+        if listing is not None and listing[0] == prefix:
+            return [_listing_item(self.bucket, x) for x in listing[1]]
+        return list_prefix(self.bucket, prefix)
+
+    @cached_prop
+    def _container_listing(self):
+        if not self.isdir() and self.parent:
+            return self.parent._container_listing
+
+        return [x.name for x in self.listing(self._listing_prefix())
+                if isinstance(x, boto.s3.key.Key)]
 
-        eulas = []
-        for x in self.bucket.list(prefix=prefix, delimiter='/'):
-            if isinstance(x, boto.s3.key.Key) and 'EULA.txt' in x.name:
-                eulas.append(os.path.basename(x.name))
-        return eulas
+    @cached_prop
+    def _container_eulas(self):
+        return [os.path.basename(x) for x in self._container_listing
+                if 'EULA.txt' in x]
+
+    def _read_key(self, name):
+        # prefetch() calls this from other threads, so use the bucket on
+        # this thread's connection
+        bucket = s3_connection.get_bucket(self.bucket.name)
+        key = boto.s3.key.Key(bucket, name)
+        try:
+            return s3_connection.retry(key.get_contents_as_string)
+        except boto.exception.S3ResponseError:
+            pass  # return None - its okay
+
+    def _prefetch_key(self, name):
+        self._prefetched[name] = self._read_key(name)
+
+    def _prefetch_listing(self):
+        # this runs on another thread, so list with the bucket on that
+        # thread's connection. The entries aren't tied to a bucket.
+        bucket = s3_connection.get_bucket(self.bucket.name)
+        prefix = self._listing_prefix()
+        self._prefetched_listing = (prefix, _listing_entries(bucket, prefix))
+
+    def _run_concurrently(self, funcs):
+        results = [_get_pool().apply_async(x) for x in funcs]
+        for r in results:
+            try:
+                r.get()
+            except Exception:
+                # it will be fetched again, and fail properly, when needed
+                log.exception('Unable to prefetch from S3')
+
+    def prefetch(self):
+        '''Fetch what rendering this directory will need from S3.
+
+        The requests are made concurrently on a thread pool. First the
+        BUILD-INFO.txt, the listing and the headers, and then the files the
+        listing shows are needed: the textile files and annotated manifest.
+        '''
+        assert self.isdir()
+        if not hasattr(self, '_prefetched'):
+            self._prefetched = {}
+
+        funcs = [lambda: self.build_info_buffer, self._prefetch_listing]
+        for x in ('HEADER.textile', 'HEADER.html'):
+            key = self.pathname2url(self._file_key(x))
+            funcs.append(lambda key=key: self._prefetch_key(key))
+        self._run_concurrently(funcs)
+
+        wanted = settings.ANDROID_FILES + settings.LINUX_FILES + [
+            settings.ANNOTATED_XML]
+        funcs = []
+        # if the listing failed there is nothing more to prefetch
+        if not hasattr(self, '_prefetched_listing'):
+            return
+        for key in self._container_listing:
+            if os.path.basename(key) in wanted:
+                funcs.append(lambda key=key: self._prefetch_key(key))
+        self._run_concurrently(funcs)
 
     def get_eulas(self):
         '''find eulas for this artifact
@@ -133,7 +400,7 @@ class S3Artifact(Artifact):
         '''
         return self._container_eulas
 
-    def get_file_contents(self, fname):
+    def _file_key(self, fname):
         if self.urlbase == '/':
             key = settings.S3_PREFIX_PATH[:-1]
         else:
@@ -143,11 +410,21 @@ class S3Artifact(Artifact):
             key += '/' + self.file_name + '/' + fname
         else:
             key += '/' + os.path.dirname(self.file_name) + fname
-        try:
-            key = boto.s3.key.Key(self.bucket, self.pathname2url(key))
-            return key.get_contents_as_string()
-        except boto.exception.S3ResponseError:
-            pass  # return None - its okay
+        return key
+
+    def _get_prefetched(self, key):
+        '''Return (True, contents) if prefetch() has read key.'''
+        prefetched = getattr(self, '_prefetched', {})
+        if key in prefetched:
+            return True, prefetched[key]
+        return False, None
+
+    def get_file_contents(self, fname):
+        key = self.pathname2url(self._file_key(fname))
+        found, contents = self._get_prefetched(key)
+        if found:
+            return contents
+        return self._read_key(key)
 
     def get_textile_files(self):
         assert self.isdir()
@@ -157,13 +434,20 @@ class S3Artifact(Artifact):
         allowed = settings.ANDROID_FILES + settings.LINUX_FILES
         for x in self.children:
             if not x.isdir() and os.path.basename(x.item.name) in allowed:
-                yield (x.item.name, x.item)
+                found, contents = self._get_prefetched(x.item.name)
+                if found and contents is not None:
+                    yield (x.item.name, StringIO(contents))
+                else:
+                    yield (x.item.name, x.item)
 
     def get_annotated_manifest(self):
         assert self.isdir()
         for x in self.children:
             if not x.isdir() and \
                     os.path.basename(x.item.name) == settings.ANNOTATED_XML:
+                found, contents = self._get_prefetched(x.item.name)
+                if found and contents is not None:
+                    return contents
                 return x.item.read()
 
     def isdir(self):
@@ -171,7 +455,8 @@ class S3Artifact(Artifact):
 
     def get_real_name(self):
         url = self.url()
-        path = self.get_file_contents('.s3_linked_from')
+        key = self.pathname2url(self._file_key('.s3_linked_from'))
+        path = read_link(self.bucket, key)
         if path:
             path = path.replace(settings.S3_PREFIX_PATH, '/')
             url = url.replace(os.path.dirname(url), path)
@@ -1,11 +1,75 @@
+import copy
+import hashlib
 import os
 import fnmatch
+import re
+
+from lru import LRUCache
+
+# number of parsed BUILD-INFO.txt documents to keep in memory
+PARSED_CACHE_SIZE = 128
+
+# python's re module allows at most 100 groups per pattern
+_MAX_GROUPS = 99
 
 
 class IncorrectDataFormatException(Exception):
         ''' Build-info data is in incorrect format. '''
 
 
+def _translate(pattern):
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('\\Z(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class _BlockMatcher(object):
+    '''Matches file names against the Files-Pattern keys of one block.
+
+    Exact names are a dict lookup, glob patterns are combined into a
+    regex with one group per pattern. Alternatives are tried in the same
+    order the keys are iterated in, so the first matching pattern wins
+    just like a fnmatch loop over the block.
+    '''
+
+    def __init__(self, block):
+        self.block = block
+        self.patterns = [x for x in block if x != 'format-version']
+        self.regexes = []
+        for i in range(0, len(self.patterns), _MAX_GROUPS):
+            chunk = self.patterns[i:i + _MAX_GROUPS]
+            regex = '|'.join('(%s)' % _translate(x) for x in chunk)
+            self.regexes.append((i, re.compile(regex, re.M | re.S)))
+
+    def match(self, fname):
+        if fname in self.block:
+            return self.block[fname]
+        for offset, regex in self.regexes:
+            m = regex.match(fname)
+            if m:
+                return self.block[self.patterns[offset + m.lastindex - 1]]
+
+
+class Matcher(object):
+    '''Compiled form of a build_info_array for resolving file names.'''
+
+    def __init__(self, build_info_array):
+        self.build_info_array = build_info_array
+        self.blocks = [_BlockMatcher(x) for x in build_info_array]
+
+    def match(self, fname):
+        for block in self.blocks:
+            info = block.match(fname)
+            if info is not None:
+                return info
+        return [{}]
+
+    def match_many(self, fnames):
+        '''Return a dict of file name to the block info applying to it.'''
+        return dict((x, self.match(x)) for x in fnames)
+
+
 class BuildInfoBase(object):
     fields_defined = [
         "format-version", "files-pattern", "build-name", "theme",
@@ -20,14 +84,61 @@ class BuildInfoBase(object):
 
         self.index = 0
         self.build_info_array = [{}]
+        self._matcher = None
 
         lines = [x for x in content.split('\n') if x.strip()]
         self.parseData(lines)
 
-        self.file_info_array = self.getInfoForFile()
+        self._files = {}
+        self._select_file()
+
+    @property
+    def matcher(self):
+        if self._matcher is None or \
+                self._matcher.build_info_array is not self.build_info_array:
+            self._matcher = Matcher(self.build_info_array)
+        return self._matcher
+
+    def _select_file(self, info=None):
+        if info is None:
+            info = self.getInfoForFile()
+        self.file_info_array = info
+        if isinstance(self.file_info_array, list):
+            # the list belongs to build_info_array which may be shared with
+            # other file names, so don't let remove_false_positives modify it
+            self.file_info_array = list(self.file_info_array)
         self.remove_false_positives()
         self.max_index = len(self.file_info_array)
 
+    def for_file(self, full_name):
+        """Return a BuildInfoBase for full_name that shares this parse.
+
+        Results are kept per file name, so each name is only matched
+        against the Files-Pattern entries once.
+        """
+        fname = os.path.basename(full_name)
+        bi = self._files.get(fname)
+        if bi is None:
+            bi = copy.copy(self)
+            bi.fname = fname
+            bi._select_file()
+            self._files[fname] = bi
+        return bi
+
+    def for_files(self, names):
+        """Return a dict of file name to BuildInfoBase like for_file.
+
+        All names not seen before are resolved in a single matcher pass.
+        """
+        fnames = dict((x, os.path.basename(x)) for x in names)
+        todo = set(x for x in fnames.values() if x not in self._files)
+        for fname, info in self.matcher.match_many(todo).items():
+            bi = copy.copy(self)
+            bi.fname = fname
+            bi._select_file(info)
+            self._files[fname] = bi
+        return dict((x, self._files[fnames[x]]) for x in names)
+
     # Get value of specified field in block index for
     # corresponding file
     def get(self, field, index=0):
@@ -40,6 +151,7 @@ class BuildInfoBase(object):
         """Record set of directives applying to a file pattern
         key: file pattern
         value: list of dicts of field/val pairs"""
+        self._matcher = None
         if key in self.build_info_array[self.index]:
             # A repeated key indicates we have found another chunk of
             # build-info
@@ -119,16 +231,7 @@ class BuildInfoBase(object):
                             self._set(pattern.strip(), block)
 
     def getInfoForFile(self):
-        for block in self.build_info_array:
-            if self.fname in block:
-                # File name matches a key directly - don't need to iterate
-                # through each using fnmatch to implement globs.
-                return block[self.fname]
-            for key in block:
-                if key != 'format-version':
-                    if fnmatch.fnmatch(self.fname, key):
-                        return block[key]
-        return [{}]
+        return self.matcher.match(self.fname)
 
     def remove_false_positives(self):
         open_type = []
@@ -148,6 +251,33 @@ class BuildInfoBase(object):
                 self.file_info_array.pop(index)
 
 
+_parsed = LRUCache(PARSED_CACHE_SIZE)
+
+
+def _document(content):
+    digest = hashlib.md5(content).hexdigest()
+    doc = _parsed.get(digest)
+    if doc is None:
+        doc = BuildInfoBase('', content)
+        _parsed.set(digest, doc)
+    return doc
+
+
+def from_buffer(full_name, content):
+    """Return a BuildInfoBase for full_name from BUILD-INFO.txt content.
+
+    Parsed documents are cached by the digest of their content, so files
+    sharing a BUILD-INFO.txt don't parse it again. The returned object may
+    be shared and must not be modified.
+    """
+    return _document(content).for_file(full_name)
+
+
+def from_buffer_many(names, content):
+    """Return a dict of name to BuildInfoBase like from_buffer."""
+    return _document(content).for_files(names)
+
+
 class BuildInfo(BuildInfoBase):
     def __init__(self, fn):
 
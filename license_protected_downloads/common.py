@@ -1,18 +1,38 @@
-import fnmatch
+import collections
+import hashlib
+import heapq
+import math
 import os
 import re
+import threading
 
 import boto
 
 from django.conf import settings
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.http import Http404
+from django.utils.encoding import force_bytes
 
-from license_protected_downloads import models
+from license_protected_downloads import (
+    buildinfo,
+    dir_index,
+    models,
+    wildcard,
+)
 from license_protected_downloads.artifact import(
     LocalArtifact,
     S3Artifact,
 )
+from license_protected_downloads.artifact.base import (
+    license_list,
+    safe_license_digests,
+)
+from license_protected_downloads.artifact.s3 import (
+    list_prefix,
+    match_prefix,
+    read_link,
+)
 
 
 def safe_path_join(base_path, *paths):
@@ -33,46 +53,98 @@ def safe_path_join(base_path, *paths):
     return target_path
 
 
-def cached_call(key, func, *args, **kwargs):
-    key = func.__name__ + key
-    v = cache.get(key)
-    if v:
+_MISSING = object()
+_NOT_FOUND = 'llp-http404'
+
+_cache_stats = collections.defaultdict(collections.Counter)
+_cache_stats_lock = threading.Lock()
+
+
+def _count(func, what):
+    with _cache_stats_lock:
+        _cache_stats[func.__name__][what] += 1
+
+
+def cache_stats():
+    '''Return {function name: {'hit': n, 'miss': n, 'not_found': n}}'''
+    with _cache_stats_lock:
+        return dict((k, dict(v)) for k, v in _cache_stats.items())
+
+
+def _cache_key(request, path, func):
+    # Everything that can change the answer for a path has to be part of the
+    # key: the query string (which holds the API key that can remap the path
+    # to a private upload area), whether the user is logged in, and the
+    # served paths so sites sharing a cache server don't see each other.
+    user = getattr(request, 'user', None)
+    parts = [
+        path,
+        sorted(request.GET.lists()),
+        bool(user and user.is_authenticated()),
+        settings.SERVED_PATHS,
+        settings.UPLOAD_PATH,
+    ]
+    digest = hashlib.md5(force_bytes(repr(parts))).hexdigest()
+    return 'llp:%s:%s' % (func.__name__, digest)
+
+
+def cached_call(request, path, func, *args, **kwargs):
+    '''Return func(*args, **kwargs), memoized in the django cache.
+
+    Results are cached for settings.CACHE_TIMEOUTS[func.__name__] seconds
+    (or the cache's default timeout). An Http404 raised by func is cached
+    for settings.CACHE_NEGATIVE_TIMEOUT seconds so repeated probes for
+    missing paths don't go to disk and S3 each time.
+    '''
+    key = _cache_key(request, path, func)
+    v = cache.get(key, _MISSING)
+    if v is not _MISSING:
+        if isinstance(v, tuple) and v[0] == _NOT_FOUND:
+            _count(func, 'not_found')
+            # restore any description the 404 page should show
+            request.path = v[1]
+            raise Http404
+        _count(func, 'hit')
         return v
-    v = func(*args, **kwargs)
-    cache.set(key, v)
+
+    _count(func, 'miss')
+    try:
+        v = func(*args, **kwargs)
+    except Http404:
+        cache.set(key, (_NOT_FOUND, request.path),
+                  settings.CACHE_NEGATIVE_TIMEOUT)
+        raise
+    cache.set(key, v, settings.CACHE_TIMEOUTS.get(
+        func.__name__, DEFAULT_TIMEOUT))
     return v
 
 
+def _unique_match(request, matches):
+    if len(matches) > 1:
+        # change request.path so that the 404.html page can show
+        # a descriptive error
+        request.path = 'Multiple files match this expression'
+        raise Http404
+    if matches:
+        return matches[0]
+
+
 def _handle_wildcard(request, fullpath):
     path, name = os.path.split(fullpath)
 
     if not os.path.isdir(path):
         return None
 
-    match = None
-    for f in os.listdir(path):
-        if fnmatch.fnmatch(f, name):
-            if match:
-                # change request.path so that the 404.html page can show
-                # a descriptive error
-                request.path = 'Multiple files match this expression'
-                raise Http404
-            match = os.path.join(path, f)
-    return match
+    match = _unique_match(request, wildcard.match_dir(path, name))
+    if match:
+        return os.path.join(path, match)
 
 
 def _handle_s3_wildcard(request, bucket, prefix):
     prefix, base = os.path.split(prefix)
     if '*' in base or '?' in base:
-        match = None
-        prefix += '/'
-        items = list(bucket.list(delimiter='/', prefix=prefix))
-        for item in items:
-            if fnmatch.fnmatch(os.path.basename(item.name), base):
-                if match:
-                    request.path = 'Multiple files match this expression'
-                    raise Http404
-                match = item
+        match = _unique_match(
+            request, match_prefix(bucket, prefix + '/', base))
         if match:
             return S3Artifact(bucket, match, None, False)
 
@@ -103,8 +175,7 @@ def _find_s3_artifact(request, path):
         # s3 listing give sub dir, we don't want that
         prefix = prefix[:-1]
 
-    items = b.list(delimiter='/', prefix=prefix)
-    for item in items:
+    for item in list_prefix(b, prefix):
         if isinstance(item, boto.s3.prefix.Prefix):
             if item.name == prefix + '/':
                 return S3Artifact(b, item, None, False)
@@ -121,8 +192,9 @@ def find_artifact(request, path):
         fullpath = safe_path_join(basepath, path)
         if fullpath is None:
             break
-        if os.path.isfile(fullpath) or os.path.isdir(fullpath):
-            return LocalArtifact(None, '', path, False, basepath)
+        st = dir_index.lookup(fullpath)
+        if st is not None:
+            return LocalArtifact(None, '', path, False, basepath, st)
 
         fullpath = _handle_wildcard(request, fullpath)
         if fullpath:
@@ -136,28 +208,24 @@ def find_artifact(request, path):
     raise Http404
 
 
-def _sort_artifacts(a, b):
-    '''Ensures directory listings follow our ordering rules for artifacts.
+def listing_sort_key(name):
+    '''Return the key that orders directory listings.
 
-    If the directory is all numbers it sorts them numerically. The "latest"
-    entry will always be the first entry. Else use standard sorting.
+    The "latest" entry will always be the first entry. Build numbers
+    (integers) and releases (floats eg "16.12") come next, listed in
+    reverse order so they show newest to oldest. Everything else follows
+    in standard string order.
     '''
-    a = a.file_name
-    b = b.file_name
+    if name == 'latest':
+        return (0, 0, name)
     try:
-        # we want listings of build numbers (integers) and releases (floats eg
-        # "16.12" to listed in reverse order so they show newest to oldest
-        return cmp(float(b), float(a))
-    except:
+        num = float(name)
+        if not math.isinf(num) and not math.isnan(num):
+            return (1, -num, name)
+    except ValueError:
         pass
-    # always give preference to make "latest" show first
-    if a == 'latest':
-        return -1
-    elif b == 'latest':
-        return 1
+    return (2, 0, name)
 
-    # just do a normal string sort
-    return cmp(a, b)
 
 def s3_replace_latest(url, bucket=None):
     ''' read .s3_linked_from file to find out the original directory to read from
@@ -174,60 +242,175 @@ def s3_replace_latest(url, bucket=None):
 
     s3path = settings.S3_PREFIX_PATH + link_from
 
-    key = boto.s3.key.Key(bucket, s3path)
-    # if there's no key already, there's no .s3_linked_from, so we're done here
-    if key is None:
+    redir_loc = read_link(bucket, s3path)
+    # if there's no .s3_linked_from, or we had a problem getting its
+    # contents, stop trying to intercept the request
+    if not redir_loc:
         return url
-    try:
-        redir_loc = key.get_contents_as_string().strip()
-        # .s3_linked_from is referencing itself?  Should return original url
-        if redir_loc == s3path:
-            return url
-        # scrub the s3 prefix
-        new_url = re.sub("^%s" % settings.S3_PREFIX_PATH, '', redir_loc)
-        # reconstruct the url
-        if m.group('target') != "":
-            new_url = "%s/%s" % (new_url, m.group('target'))
-        return new_url
-    except:
-        # problem gettings contents, so stop trying to intercept the request
+    # .s3_linked_from is referencing itself?  Should return original url
+    if redir_loc == s3path:
         return url
+    # scrub the s3 prefix
+    new_url = re.sub("^%s" % settings.S3_PREFIX_PATH, '', redir_loc)
+    # reconstruct the url
+    if m.group('target') != "":
+        new_url = "%s/%s" % (new_url, m.group('target'))
+    return new_url
 
 
-def _s3_list(bucket, url):
+def _s3_prefix(bucket, url):
     prefix = settings.S3_PREFIX_PATH + url
     if prefix[-1] != '/':
         # s3 listing needs '/' to do a dir listing
         prefix = prefix + '/'
-    prefix = s3_replace_latest(prefix, bucket)
-    for item in bucket.list(delimiter='/', prefix=prefix):
+    return s3_replace_latest(prefix, bucket)
+
+
+def _s3_list(bucket, url, artifact=None):
+    prefix = _s3_prefix(bucket, url)
+    if isinstance(artifact, S3Artifact):
+        # uses the listing artifact.prefetch() made
+        items = artifact.listing(prefix)
+    else:
+        items = list_prefix(bucket, prefix)
+    for item in items:
         if item.name != prefix:
             yield item
 
 
-def dir_list(artifact, human_readable=True):
+def _resolve_build_info(parent, entries):
+    '''Match all files of a listing against BUILD-INFO.txt in one pass.
+
+    The per-file results are memoized with the parsed document, so the
+    build-info lookups done to get each file's license digests are just
+    lookups.
+    '''
+    buf = parent.build_info_buffer
+    if not buf:
+        return
+    names = [x.file_name for x in entries if not x.isdir()]
+    try:
+        buildinfo.from_buffer_many(names, buf)
+    except buildinfo.IncorrectDataFormatException:
+        # reported per-file when getting the license digests
+        pass
+
+
+def _license_digest_list(parent, entry, child, eulas):
+    if entry.isdir():
+        return []
+    if child is not None:
+        return child.license_digest_list
+    return safe_license_digests(
+        entry.url, parent.get_child_license_digests, entry.name, eulas)
+
+
+def listing_marker(entry):
+    '''Return the key entries are ordered by in iter_dir_list.
+
+    This is the order S3 lists keys in, so directories sort as if they had
+    their trailing "/".
+    '''
+    if entry.isdir():
+        return entry.name + '/'
+    return entry.name
+
+
+def _s3_entries(bucket, url, human_readable, marker):
+    prefix = _s3_prefix(bucket, url)
+    kwargs = {}
+    if marker:
+        kwargs['marker'] = prefix + marker
+    # boto fetches the pages of this listing as they are iterated
+    for item in bucket.list(delimiter='/', prefix=prefix, **kwargs):
+        if item.name != prefix:
+            artifact = S3Artifact(bucket, item, None, human_readable)
+            yield artifact.listing_entry()
+
+
+def _decorate(index, items, key):
+    '''Prepare items for heapq.merge, on ties lower indexes come first.'''
+    for item in items:
+        yield key(item), index, item
+
+
+def iter_dir_list(artifact, human_readable=True, marker=None):
+    '''Yield the entries of a directory as they are listed.
+
+    Unlike dir_list() entries come in the lexical order of listing_marker(),
+    S3 is listed page by page rather than all at once, and the license
+    fields aren't filled in. Only entries after marker are returned, so a
+    listing can be resumed from the listing_marker() of its last entry.
+    '''
     url = artifact.url()
-    artifacts = []
+    sources = []
     if isinstance(artifact, LocalArtifact):
-        fp = artifact.full_path
-        artifacts = [LocalArtifact(artifact, url, x, human_readable, fp)
-                     for x in os.listdir(fp)]
+        entries = artifact.list_entries(human_readable)
+        sources.append(sorted(_decorate(0, entries, listing_marker)))
 
     b = S3Artifact.get_bucket()
     if b:
-        for item in _s3_list(b, url[1:]):
-            artifacts.append(S3Artifact(b, item, artifact, human_readable))
+        entries = _s3_entries(b, url[1:], human_readable, marker)
+        sources.append(_decorate(1, entries, listing_marker))
 
-    artifacts.sort(_sort_artifacts)
+    # local entries are merged first so they win over duplicates from s3
+    last = None
+    for key, _, entry in heapq.merge(*sources):
+        if key == last or (marker and key <= marker) or entry.hidden():
+            continue
+        last = key
+        yield entry
 
-    # s3 and local could return duplicate names. Since the artifacts are sorted
-    # we can check if the last names match and skip duplicates if needed. This
-    # gives precedence to local artifacts since they show up first in the array
-    last_name = None
-    listing = []
-    for artifact in artifacts:
-        if last_name != artifact.file_name and not artifact.hidden():
-            listing.append(artifact.get_listing())
 
-        last_name = artifact.file_name
-    return listing
+def _pair_sort_key(pair):
+    return listing_sort_key(pair[0].name)
+
+
+def dir_list(artifact, human_readable=True):
+    url = artifact.url()
+    # each source is a sorted list of pairs of (ListingEntry, artifact).
+    # Local files are listed without creating an artifact for each, so
+    # their artifact is None.
+    sources = []
+    if isinstance(artifact, LocalArtifact):
+        entries = [(x, None) for x in artifact.list_entries(human_readable)]
+        sources.append(sorted(_decorate(0, entries, _pair_sort_key)))
+
+    b = S3Artifact.get_bucket()
+    if b:
+        entries = []
+        for item in _s3_list(b, url[1:], artifact):
+            # s3 children register with their parent which needs them for
+            # finding textile files, so they still get an artifact
+            child = S3Artifact(b, item, artifact, human_readable)
+            entries.append((child.listing_entry(), child))
+        sources.append(sorted(_decorate(1, entries, _pair_sort_key)))
+
+    # s3 and local could return duplicate names. Those end up next to each
+    # other in the merge, local first, so skipping a name that matches the
+    # last one gives precedence to local artifacts.
+    last_name = None
+    visible = []
+    for _, _, (entry, child) in heapq.merge(*sources):
+        if last_name != entry.name and not entry.hidden():
+            visible.append((entry, child))
+
+        last_name = entry.name
+
+    _resolve_build_info(artifact, [x for x, _ in visible])
+    eulas = None
+    if any(child is None and not entry.isdir() for entry, child in visible):
+        eulas = artifact.get_eulas()
+
+    # resolve the licenses of the whole directory with one query
+    digests = set()
+    for entry, child in visible:
+        ldl = _license_digest_list(artifact, entry, child, eulas)
+        entry.license_digest_list = ldl
+        if isinstance(ldl, list):
+            digests.update(ldl)
+    licenses = models.License.objects.by_digest(digests)
+    for entry, _ in visible:
+        entry.license_list = license_list(
+            entry.license_digest_list, licenses)
+    return [x for x, _ in visible]
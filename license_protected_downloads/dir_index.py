@@ -0,0 +1,136 @@
+'''An in-process index of the local directories we serve.
+
+Listing a directory, finding its EULAs, BUILD-INFO.txt and textile files
+all need the names and stat info of its entries. The index reads the names
+once and keeps them until the directory's mtime changes, so a hot directory
+only costs a stat of the directory itself. An entry is only stat'ed when
+it is asked about, as downloading a file only needs a few of the entries
+next to it.
+
+Changing a file in place doesn't change its directory's mtime, so entries
+are also re-read after LOCAL_INDEX_TIMEOUT seconds.
+'''
+import fnmatch
+import os
+import stat
+import time
+
+from django.conf import settings
+
+from license_protected_downloads.lru import LRUCache
+
+# number of directories to remember
+DIR_INDEX_SIZE = 1024
+# number of results derived from the entries to remember for each directory
+DERIVED_SIZE = 32
+
+_MISSING = object()
+
+_indexes = LRUCache(DIR_INDEX_SIZE)
+
+
+class DirIndex(object):
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.built = time.time()
+        # os.listdir order is kept, some callers pick the first match
+        self.names = os.listdir(path)
+        self._names = frozenset(self.names)
+        self._stats = {}
+        # results derived from the entries, see cached()
+        self._derived = LRUCache(DERIVED_SIZE)
+
+    def valid(self, mtime, now):
+        # a change made in the same instant the index was built may not
+        # have changed the mtime, so such an index is never reused
+        return (mtime == self.mtime and self.built - mtime > 1 and
+                now - self.built < settings.LOCAL_INDEX_TIMEOUT)
+
+    def cached(self, key, func, *args):
+        '''Return func(*args), remembered along with this index.
+
+        Only the DERIVED_SIZE most recently used results are kept.
+        '''
+        v = self._derived.get(key, _MISSING)
+        if v is _MISSING:
+            v = func(*args)
+            self._derived.set(key, v)
+        return v
+
+    def stat(self, name):
+        '''Return os.stat() of an entry, or None if it doesn't exist.'''
+        if name not in self._names:
+            return None
+        try:
+            return self._stats[name]
+        except KeyError:
+            pass
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            # a broken symlink, or removed since the names were read
+            st = None
+        self._stats[name] = st
+        return st
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def isdir(self, name):
+        st = self.stat(name)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self, name):
+        st = self.stat(name)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    @property
+    def eulas(self):
+        '''The names glob.glob(path + '/*EULA.txt*') would find.'''
+        return self.cached('eulas', lambda: [
+            x for x in self.names
+            if x[0] != '.' and fnmatch.fnmatch(x, '*EULA.txt*')])
+
+
+def get(path):
+    '''Return the DirIndex of path, or None if it isn't a directory.'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    index = _indexes.get(path)
+    if index is None or not index.valid(st.st_mtime, time.time()):
+        try:
+            index = DirIndex(path, st.st_mtime)
+        except OSError:
+            return None
+        _indexes.set(path, index)
+    return index
+
+
+def lookup(path):
+    '''Return os.stat(path), or None if path doesn't exist.
+
+    The index of its directory is used if a valid one is cached, but none
+    is built just for this, as that would stat every entry of the directory.
+    '''
+    parent, name = os.path.split(path)
+    index = _indexes.get(parent) if name else None
+    if index is not None:
+        try:
+            valid = index.valid(os.stat(parent).st_mtime, time.time())
+        except OSError:
+            valid = False
+        if valid:
+            return index.stat(name)
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def clear():
+    _indexes.clear()
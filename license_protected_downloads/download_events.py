@@ -0,0 +1,140 @@
+'''Queue download events and write them out in batches.
+
+Download.mark() used to append a row to settings.REPORT_CSV on every
+request. Events are now queued in memory and written to segment files
+next to REPORT_CSV, by a background thread or once DOWNLOAD_FLUSH_SIZE
+events are waiting. Each segment is written under a temporary name and
+renamed into place, so report_process never sees a partial file and no
+locking is needed between worker processes.
+
+If events arrive faster than they can be written, at most
+DOWNLOAD_QUEUE_SIZE are kept and the rest are dropped and counted.
+'''
+import atexit
+import collections
+import csv
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger("llp.downloads")
+
+
+def segment_name(seq):
+    '''Return the file name of a new segment for report_process to pick up.
+
+    The name matches the "<REPORT_CSV stem>_*.csv" files report_process
+    reads, and is unique across hosts and processes.
+    '''
+    stem, ext = os.path.splitext(settings.REPORT_CSV)
+    return '%s_seg-%s-%d-%s-%d%s' % (
+        stem, socket.gethostname(), os.getpid(),
+        time.strftime('%Y%m%d%H%M%S'), seq, ext)
+
+
+class EventQueue(object):
+    def __init__(self):
+        self._rows = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._seq = itertools.count()
+        self._pid = None
+        self._thread = None
+        self._stopped = False
+        self.counters = collections.Counter()
+
+    def _start_flusher(self):
+        # a thread started before a fork doesn't exist in the child, and
+        # the rows inherited from the parent are the parent's to write
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            self._rows.clear()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._flusher, name='download-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _flusher(self):
+        while not self._stopped:
+            self._wakeup.wait(settings.DOWNLOAD_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        '''Stop the background thread and write what is left.'''
+        self._stopped = True
+        if self._thread is not None and self._pid == os.getpid():
+            self._wakeup.set()
+            self._thread.join()
+        self.flush()
+
+    def put(self, row):
+        '''Queue a row for REPORT_CSV, dropping it if the queue is full.'''
+        with self._lock:
+            self._start_flusher()
+            if len(self._rows) >= settings.DOWNLOAD_QUEUE_SIZE:
+                self.counters['dropped'] += 1
+                return False
+            self._rows.append(row)
+            self.counters['queued'] += 1
+            waiting = len(self._rows)
+        if waiting >= settings.DOWNLOAD_FLUSH_SIZE:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        '''Write the queued rows to a new segment file.
+
+        Returns the number of rows written. Rows that couldn't be written
+        are put back to be tried again.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._rows)
+                self._rows.clear()
+            if not rows:
+                return 0
+            name = segment_name(next(self._seq))
+            try:
+                with open(name + '.tmp', 'w') as f:
+                    csv.writer(f).writerows(rows)
+                os.rename(name + '.tmp', name)
+            except (IOError, OSError):
+                log.exception('unable to write download events to %s', name)
+                with self._lock:
+                    self._rows.extendleft(reversed(rows))
+                    self.counters['errors'] += 1
+                return 0
+            with self._lock:
+                self.counters['written'] += len(rows)
+                self.counters['flushes'] += 1
+            return len(rows)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['waiting'] = len(self._rows)
+        return stats
+
+
+queue = EventQueue()
+put = queue.put
+flush = queue.flush
+
+
+@atexit.register
+def _stop_at_exit():
+    # a daemon thread still waiting when the interpreter shuts down dies
+    # with an error, so it's stopped here first
+    try:
+        queue.stop()
+    except Exception:
+        log.exception('unable to flush download events')
@@ -0,0 +1,192 @@
+'''Move the downloads of old months out of the database and back.
+
+The download table only grows, while the reports only ever look at a month
+at a time and the monthly report tables already hold the counts. Months
+older than DOWNLOAD_ARCHIVE_KEEP_MONTHS are written to gzipped CSV files
+in DOWNLOAD_ARCHIVE_DIR and deleted, so the table and its indexes only hold
+the recent months. A month can be restored when its per-file or
+per-country details are needed again.
+
+Downloads can still turn up for a month once it's been archived, archiving
+it again adds a new numbered segment next to the ones already written. The
+archived months are recorded as ArchivedMonth, so rebuild_rollups() keeps
+their counts rather than recounting what is left in the database.
+'''
+import csv
+import datetime
+import glob
+import gzip
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min
+
+from license_protected_downloads.management.commands.report_process import (
+    BATCH_SIZE,
+    parse_timestamp,
+    str2bool,
+)
+from license_protected_downloads.models import ArchivedMonth, Download
+
+FIELDS = ('timestamp', 'ip', 'name', 'link', 'country', 'region_isp', 'ref')
+
+
+def archive_name(year_month, segment):
+    return os.path.join(settings.DOWNLOAD_ARCHIVE_DIR,
+                        'downloads-%s.%d.csv.gz' % (year_month, segment))
+
+
+def archive_segments(year_month):
+    '''Return the {segment: file name} of the archives of a month.'''
+    segments = {}
+    for name in glob.glob(archive_name(year_month, 0).replace(
+            '.0.csv.gz', '.*.csv.gz')):
+        try:
+            segments[int(name.split('.')[-3])] = name
+        except ValueError:
+            pass
+    return segments
+
+
+def parse_month(year_month):
+    try:
+        return datetime.datetime.strptime(year_month, '%Y.%m')
+    except ValueError:
+        raise CommandError('Invalid month "%s", expected YYYY.MM' % year_month)
+
+
+def month_downloads(year_month):
+    start = parse_month(year_month)
+    return Download.objects.filter(
+        timestamp__gte=start, timestamp__lt=Download.next_month(start))
+
+
+def closed_months(keep):
+    '''Return the months with downloads before the last keep months.'''
+    first = Download.objects.aggregate(first=Min('timestamp'))['first']
+    if first is None:
+        return []
+    now = datetime.datetime.now()
+    end = now.year * 12 + now.month - 1 - keep
+    return ['%04d.%02d' % (m // 12, m % 12 + 1)
+            for m in range(first.year * 12 + first.month - 1, end)]
+
+
+def _encode(val):
+    if val is None:
+        return ''
+    if isinstance(val, unicode):
+        return val.encode('utf-8')
+    return val
+
+
+def _decode(row):
+    timestamp, ip, name, link, country, region_isp, ref = row
+    return Download(
+        timestamp=parse_timestamp(timestamp), ip=ip, name=name.decode('utf-8'),
+        link=str2bool(link), country=country.decode('utf-8') or None,
+        region_isp=region_isp.decode('utf-8') or None,
+        ref=ref.decode('utf-8') or None)
+
+
+def archive_month(year_month):
+    '''Write the downloads of a month to its archive and delete them.
+
+    Returns the number of downloads archived, or None if the month still
+    has downloads downloads_report hasn't counted.
+    '''
+    year_month = parse_month(year_month).strftime('%Y.%m')
+    qs = month_downloads(year_month)
+    if qs.filter(country=None).exists():
+        return None
+    name = archive_name(
+        year_month, max(archive_segments(year_month) or [0]) + 1)
+    last = None
+    count = 0
+    with gzip.open(name + '.tmp', 'wb') as f:
+        writer = csv.writer(f)
+        rows = qs.order_by('timestamp', 'id').values_list('id', *FIELDS)
+        for row in rows.iterator():
+            last = max(last, row[0])
+            writer.writerow([_encode(x) for x in row[1:]])
+            count += 1
+    if not count:
+        os.remove(name + '.tmp')
+        return 0
+    # downloads added since they were read aren't in the archive, and if
+    # the archive can't be put in place the delete is rolled back. Writing a
+    # new segment never replaces what was archived before
+    with transaction.atomic():
+        ArchivedMonth.objects.get_or_create(month=year_month)
+        qs.filter(id__lte=last).delete()
+        os.rename(name + '.tmp', name)
+    return count
+
+
+def restore_month(year_month, batch_size=BATCH_SIZE):
+    '''Load the downloads of a month back from all its archive segments.
+
+    The downloads still in the database were never archived, so they're
+    kept as they are.
+    '''
+    year_month = parse_month(year_month).strftime('%Y.%m')
+    segments = archive_segments(year_month)
+    if not segments:
+        raise CommandError('%s has not been archived' % year_month)
+    count = 0
+    with transaction.atomic():
+        for segment in sorted(segments):
+            with gzip.open(segments[segment], 'rb') as f:
+                batch = []
+                for row in csv.reader(f):
+                    batch.append(_decode(row))
+                    if len(batch) >= batch_size:
+                        Download.objects.bulk_create(batch)
+                        count += len(batch)
+                        batch = []
+                Download.objects.bulk_create(batch)
+                count += len(batch)
+        ArchivedMonth.objects.filter(month=year_month).delete()
+    for name in segments.values():
+        os.remove(name)
+    return count
+
+
+class Command(BaseCommand):
+    help = 'Archive the downloads of old months, or restore them'
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('months', nargs='*', metavar='YYYY.MM',
+                            help='Months to archive or restore, archiving '
+                                 'defaults to the months before the last '
+                                 '--keep months')
+        parser.add_argument('--restore', action='store_true',
+                            help='Load the months back into the database')
+        parser.add_argument('--keep', type=int,
+                            default=settings.DOWNLOAD_ARCHIVE_KEEP_MONTHS,
+                            help='Number of recent months not to archive')
+
+    def handle(self, *args, **options):
+        months = options['months']
+        if options['restore']:
+            if not months:
+                raise CommandError('Give the months to restore')
+            for month in months:
+                count = restore_month(month)
+                self.stdout.write('Restored %d downloads of %s' % (
+                    count, month))
+            return
+
+        if not os.path.isdir(settings.DOWNLOAD_ARCHIVE_DIR):
+            os.makedirs(settings.DOWNLOAD_ARCHIVE_DIR)
+        for month in months or closed_months(options['keep']):
+            count = archive_month(month)
+            if count is None:
+                self.stdout.write(
+                    'Skipping %s, run downloads_report first' % month)
+            elif count:
+                self.stdout.write('Archived %d downloads of %s' % (
+                    count, month))
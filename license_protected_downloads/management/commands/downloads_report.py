@@ -6,53 +6,118 @@ import datetime
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
 
 from IP2Location import IP2Location
 
-from license_protected_downloads.models import Download
+from license_protected_downloads.models import (
+    Download,
+    add_to_rollups,
+    rebuild_rollups,
+)
+
+# distinct IPs looked up and updated, or duplicates deleted, at a time
+CHUNK_SIZE = 1000
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class Command(BaseCommand):
     help = 'Go through downloads and fill out empty region/isp information'
 
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--rebuild-rollups', action='store_true',
+                            help='Recount the monthly report tables from '
+                                 'all downloads')
+
     def handle(self, *args, **options):
         ipl = IP2Location(settings.IP2LOCATION_FILE)
         dups = self._find_dups()
         self._remove_dups(dups)
-        for download in Download.objects.filter(country=None):
-            try:
-                loc = ipl.get_all(download.ip)
-                download.country = loc.country_short
-                download.region_isp = '%s / %s' % (loc.region, loc.isp)
-            except:
-                if ':' in download.ip:
-                    print 'Inserting ipv6-unknown for', download.id
-                    download.country = download.region_isp = 'ipv6-unknown'
-                else:
-                    print "Unable to get IP location data for:", download.id
-                    raise
-            download.save()
+        self._fill_locations(ipl)
+        if options.get('rebuild_rollups'):
+            rebuild_rollups()
+
+    @staticmethod
+    def _locate(ipl, ip):
+        '''Return the (country, region_isp) of an IP address.'''
+        try:
+            loc = ipl.get_all(ip)
+            return loc.country_short, '%s / %s' % (loc.region, loc.isp)
+        except:
+            if ':' in ip:
+                print 'Inserting ipv6-unknown for', ip
+                return 'ipv6-unknown', 'ipv6-unknown'
+            print "Unable to get IP location data for:", ip
+            raise
+
+    def _fill_locations(self, ipl):
+        '''Fill out the location of downloads that don't have one.
+
+        Each distinct IP is only looked up once, and the downloads are
+        updated with one query per location for each chunk of IPs. The
+        downloads are added to the monthly report tables as they are
+        filled out.
+
+        Only the downloads already there when this starts are filled out,
+        report_process can be adding more while it runs. Otherwise those
+        could be filled out by an update without having been counted.
+        '''
+        max_id = Download.objects.aggregate(max_id=Max('id'))['max_id']
+        if max_id is None:
+            return
+        todo = Download.objects.filter(country=None, id__lte=max_id)
+        ips = todo.values_list(
+            'ip', flat=True).distinct().order_by().iterator()
+        for chunk in _chunks(ips, CHUNK_SIZE):
+            locations = dict((ip, self._locate(ipl, ip)) for ip in chunk)
+            groups = {}
+            for ip, location in locations.items():
+                groups.setdefault(location, []).append(ip)
+            with transaction.atomic():
+                counts = Download.month_counts(
+                    todo.filter(ip__in=chunk), 'name', 'ip')
+                add_to_rollups((month, name) + locations[ip] + (count,)
+                               for month, name, ip, count in counts)
+                for (country, region_isp), group in groups.items():
+                    todo.filter(ip__in=group).update(
+                        country=country, region_isp=region_isp)
 
     def _find_dups(self):
         '''Find duplicate entries caused by multi-part downloads.
            Some browsers will do multiple requests for a single "download".
            This method attempts to find the "dups" and remove them. So that
-           we can tally true downloads'''
-        dups = []
-        downloads = {}
+           we can tally true downloads.
+
+           The ids are yielded from one pass over the downloads sorted by
+           file and IP, so only the current file and IP are kept in memory'''
         download_duration = datetime.timedelta(hours=2)
-        qs = Download.objects.filter(country=None).order_by('timestamp')
-        for download in qs:
-            file_downloads = downloads.setdefault(download.name, {})
-            ip_downloads = file_downloads.setdefault(download.ip, [])
-            window = download.timestamp - download_duration
-            if len(ip_downloads) == 0 or ip_downloads[-1].timestamp < window:
+        qs = Download.objects.filter(country=None).order_by(
+            'name', 'ip', 'timestamp', 'id').values_list(
+                'id', 'name', 'ip', 'timestamp')
+        current = last = None
+        for pk, name, ip, timestamp in qs.iterator():
+            if (name, ip) != current:
+                current = (name, ip)
+                last = None
+            if last is None or last < timestamp - download_duration:
                 # First entry, or the last download happened > 2 hours since
                 # the previous
-                ip_downloads.append(download)
+                last = timestamp
             else:
-                dups.append(download.id)
-        return dups
+                yield pk
 
     def _remove_dups(self, dups):
-        Download.objects.filter(id__in=dups).delete()
+        for chunk in _chunks(dups, CHUNK_SIZE):
+            Download.objects.filter(id__in=chunk).delete()
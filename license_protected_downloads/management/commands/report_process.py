@@ -5,7 +5,7 @@ warnings.filterwarnings("ignore", category=UserWarning)
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from license_protected_downloads.models import Download
-from django.db import DataError, DatabaseError
+from django.db import DatabaseError, connection, transaction
 import os
 import time
 import glob
@@ -13,14 +13,172 @@ import logging
 import csv
 import fcntl
 import sys
+from cStringIO import StringIO
 from datetime import datetime
 
 logging.getLogger().setLevel(logging.WARN)
 
+# rows inserted per transaction
+BATCH_SIZE = 5000
+
+
+def str2bool(val):
+    # http://stackoverflow.com/questions/715417
+    return val.lower() in ("yes", "true", "t", "1")
+
+
+def parse_timestamp(val):
+    '''Parse the str(datetime) timestamps Download.mark() writes.
+
+    Slicing the fixed format is much quicker than strptime, which is kept
+    for anything else.
+    '''
+    n = len(val)
+    if (n == 19 or (n == 26 and val[19] == '.')) and \
+            val[4] == val[7] == '-' and val[13] == val[16] == ':':
+        try:
+            return datetime(
+                int(val[0:4]), int(val[5:7]), int(val[8:10]),
+                int(val[11:13]), int(val[14:16]), int(val[17:19]),
+                int(val[20:26] or 0))
+        except ValueError:
+            pass
+    try:
+        return datetime.strptime(val, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        # handle timestamp in a different format
+        return datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
+
+
+def to_download(row):
+    # This looks odd, but we sometimes get URLs with newlines
+    # in them and we need the real file name
+    download = row[1].replace('\n', '')
+
+    # Check and see if there's a timestamp column..
+    # if not, then we fail back to the old behavior
+    # of assuming that download time is when report was run
+    if len(row) > 4:
+        download_timestamp = parse_timestamp(row[4])
+    else:
+        download_timestamp = datetime.now()
+
+    return Download(ip=row[0], name=download, link=str2bool(row[2]),
+                    ref=row[3], timestamp=download_timestamp)
+
+
+class _Lines(object):
+    '''Iterate over the lines of a file, counting the bytes read.
+
+    csv.reader only reads the lines of the row it returns, so after each row
+    offset is where the next one starts.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+
+def read_checkpoint(name):
+    try:
+        with open(name + '.offset') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def write_checkpoint(name, offset):
+    with open(name + '.offset.tmp', 'w') as f:
+        f.write(str(offset))
+    os.rename(name + '.offset.tmp', name + '.offset')
+
+
+def _copy(downloads):
+    '''Insert the downloads with PostgreSQL's COPY.'''
+    buf = StringIO()
+    # COPY reads an unquoted empty field as NULL
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL)
+    for d in downloads:
+        writer.writerow([d.timestamp, d.ip, d.name, d.link, d.ref])
+    buf.seek(0)
+
+    qn = connection.ops.quote_name
+    columns = ', '.join(
+        qn(x) for x in ('timestamp', 'ip', 'name', 'link', 'ref'))
+    with connection.cursor() as cursor:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (
+            qn(Download._meta.db_table), columns), buf)
+
+
+def insert_batch(batch):
+    '''Insert a batch of (row, download) in one go.
+
+    If the database rejects the batch, its rows are inserted one at a time
+    so only the invalid ones are skipped.
+    '''
+    downloads = [x[1] for x in batch]
+    try:
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                _copy(downloads)
+            else:
+                Download.objects.bulk_create(downloads)
+        return
+    except DatabaseError:
+        logging.warning('Batch rejected, inserting its rows one at a time')
+
+    for row, download in batch:
+        try:
+            with transaction.atomic():
+                download.save()
+        except DatabaseError:
+            logging.error('Skipping invalid download entry: %s', row)
+
+
+def process_file(name, batch_size=BATCH_SIZE):
+    '''Load a report file into the database and remove it.
+
+    The offset of the rows loaded so far is saved after each batch, so a
+    file that fails part way is resumed after the last batch loaded.
+    '''
+    with open(name) as f:
+        f.seek(read_checkpoint(name))
+        lines = _Lines(f)
+        batch = []
+        for row in csv.reader(lines):
+            try:
+                batch.append((row, to_download(row)))
+            except (IndexError, ValueError):
+                logging.error('Skipping invalid download entry: %s', row)
+            if len(batch) >= batch_size:
+                insert_batch(batch)
+                write_checkpoint(name, lines.offset)
+                batch = []
+        if batch:
+            insert_batch(batch)
+            write_checkpoint(name, lines.offset)
+    os.remove(name)
+    if os.path.exists(name + '.offset'):
+        os.remove(name + '.offset')
+
 
 class Command(BaseCommand):
     help = 'Process csv file to postgres and do some log rotating'
 
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Number of rows to insert at a time')
+
     def handle(self, *args, **options):
         # Ensure only one script is running at a time
         f = open(os.path.join(settings.REPORT_CSV + '.lock'), 'w+')
@@ -29,10 +187,6 @@ class Command(BaseCommand):
         except IOError:
             sys.exit('Script is already running')
 
-        def str2bool(self):
-            # http://stackoverflow.com/questions/715417
-            return self.lower() in ("yes", "true", "t", "1")
-
         try:
             filename, file_extension = os.path.splitext(settings.REPORT_CSV)
             timestamp = time.strftime('%H%M-%Y%m%d')
@@ -43,34 +197,9 @@ class Command(BaseCommand):
                 raise
 
         # Process any report files that have failed in the pass.
-        for name in glob.glob(filename+'_*.csv'):
+        for name in sorted(glob.glob(filename + '_*.csv')):
             try:
                 logging.info('Processing %s', name)
-                for row in csv.reader(open(name)):
-                    # This looks odd, but we sometimes get URLs with newlines
-                    # in them and we need the real file name
-                    download = row[1].replace('\n', '')
-
-                    # Check and see if there's a timestamp column..
-                    # if not, then we fail back to the old behavior
-                    # of assuming that download time is when report was run
-                    try:
-                        download_timestamp = datetime.strptime(
-                            row[4], "%Y-%m-%d %H:%M:%S.%f")
-                    except ValueError as e:
-                        # handle timestamp in a different format
-                        download_timestamp = datetime.strptime(
-                            row[4], "%Y-%m-%d %H:%M:%S")
-                    except IndexError as e:
-                        download_timestamp = datetime.now()
-
-                    try:
-                        Download.objects.create(
-                            ip=row[0], name=download, link=str2bool(row[2]),
-                            ref=row[3], timestamp=download_timestamp)
-                    except DataError:
-                        logging.error(
-                            'Skipping invalid download entry: %s', row)
-                os.remove(name)
+                process_file(name, options.get('batch_size', BATCH_SIZE))
             except (csv.Error, DatabaseError):
                 logging.exception('unable to process csv %s', name)
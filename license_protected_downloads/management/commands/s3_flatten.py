@@ -4,11 +4,10 @@ from django.core.management.base import BaseCommand
 import logging
 import datetime
 from fnmatch import fnmatch
-from boto.s3.connection import S3Connection
 from boto.s3 import deletemarker,key,prefix
 import sys
-import httplib
-from time import sleep
+
+from license_protected_downloads import s3_connection
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -69,26 +68,20 @@ class Command(BaseCommand):
             logging.info( "DRYRUN: delete_keys for %s keys" % len(delete_list) )
 
     def handle(self, *args, **options):
-        conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
-                            settings.AWS_SECRET_ACCESS_KEY)
-        self.bucket = conn.get_bucket(settings.S3_BUCKET, validate=False)
+        self.bucket = s3_connection.get_bucket()
         self.now_mark = self.x_days_ago(int(options['markdays']))
         self.now_delete = self.x_days_ago(int(options['deletedays']))
 
         self.handle_bucket_retry(*args, **options)
 
-    # wrap the handle_bucket() method in a try/except to allow us to
-    # retry if there's an httplib error.
+    # retry the handle_bucket() method if there's an httplib error.
     def handle_bucket_retry(self, *args, **options):
-        retries = 3
-        while retries > 0:
-            try:
-                self.handle_bucket(*args, **options)
-                retries = 0
-            except httplib.BadStatusLine as e:
-                logging.error("httplib error handle_bucket():  %s" % e)
-                retries -= 1
-                sleep(30)
+        try:
+            s3_connection.retry(self.handle_bucket, *args, **options)
+        except Exception as e:
+            if not s3_connection.is_transient(e):
+                raise
+            logging.error("httplib error handle_bucket():  %s" % e)
 
     def handle_bucket(self, *args, **options):
         logging.info( "--> %s" % options['prefix'])
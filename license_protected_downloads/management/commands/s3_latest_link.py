@@ -3,21 +3,20 @@ from django.core.management.base import BaseCommand
 
 import logging
 import os
-from boto.s3.connection import S3Connection
+
+from license_protected_downloads import s3_connection
+from license_protected_downloads.artifact.s3 import invalidate_link
 
 logging.getLogger().setLevel(logging.INFO)
 
 
 class Command(BaseCommand):
     help = 'Ensure the hidden dotfile is created in the latest_link folder'
-    conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
-                        settings.AWS_SECRET_ACCESS_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET, validate=False)
-    bucket_keys = bucket.list(settings.S3_PREFIX_PATH)
 
     def handle(self, *args, **options):
+        self.bucket = s3_connection.get_bucket()
         paths = []
-        for key in self.bucket_keys:
+        for key in self.bucket.list(settings.S3_PREFIX_PATH):
             if os.path.dirname(key.name).endswith('/latest'):
                 paths.append(os.path.dirname(key.name))
 
@@ -37,7 +36,8 @@ class Command(BaseCommand):
                                                                  key=int))
             new_file = os.path.join(i, key_name)
             k = self.bucket.new_key(new_file)
-            k.set_contents_from_string(file_content)
+            s3_connection.retry(k.set_contents_from_string, file_content)
+            invalidate_link(new_file)
             logging.info('creating file %s with contents %s', new_file,
                          file_content)
             list1 = []
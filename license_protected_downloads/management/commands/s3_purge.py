@@ -4,9 +4,10 @@ from django.core.management.base import BaseCommand
 import logging
 import datetime
 import fnmatch
-from boto.s3.connection import S3Connection
 from boto.s3 import deletemarker
 
+from license_protected_downloads import s3_connection
+
 logging.getLogger().setLevel(logging.INFO)
 
 
@@ -65,7 +66,8 @@ class Command(BaseCommand):
                     if not options['dryrun']:
                         try:
                             logging.info('DELETE: permanently deleting %s' % this_key)
-                            bucket.delete_keys(s3obj_buffer)
+                            s3_connection.retry(
+                                bucket.delete_keys, s3obj_buffer)
                         except Exception:
                             logging.exception('S3Connection error for %s', this_key)
                     else:
@@ -87,16 +89,14 @@ class Command(BaseCommand):
             if not options['dryrun']:
                 try:
                     logging.debug('MARK: set deletemarker on %s'%this_key)
-                    bucket.delete_key(this_key)
+                    s3_connection.retry(bucket.delete_key, this_key)
                 except Exception:
                     logging.exception('S3Connection error for %s', this_key)
             else:
                 logging.info('DRYRUN: would have marked for delete %s' % this_key)
 
     def handle(self, *args, **options):
-        conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
-                            settings.AWS_SECRET_ACCESS_KEY)
-        bucket = conn.get_bucket(settings.S3_BUCKET, validate=False)
+        bucket = s3_connection.get_bucket()
         now_mark = self.x_days_ago(int(options['markdays']))
         now_delete = self.x_days_ago(int(options['deletedays']))
 
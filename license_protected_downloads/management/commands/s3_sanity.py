@@ -3,18 +3,17 @@ from django.core.management.base import BaseCommand
 
 import logging
 import time
-from boto.s3.connection import S3Connection
+
+from license_protected_downloads import s3_connection
 
 logging.getLogger().setLevel(logging.INFO)
 
 
 class Command(BaseCommand):
     help = 'Ensure two S3 buckets are in sync by checking the etag/md5sum'
-    conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
-                        settings.AWS_SECRET_ACCESS_KEY)
 
     def slave_bucket(self, bucket):
-        slave_bucket = self.conn.get_bucket(bucket, validate=False)
+        slave_bucket = s3_connection.get_bucket(bucket)
         slave_bucket_keys = slave_bucket.list(settings.S3_PREFIX_PATH)
         slave_keys = {(key_val.name, key_val.etag) for key_val in
                       slave_bucket_keys}
@@ -24,8 +23,7 @@ class Command(BaseCommand):
         master_bucket_name = 'publishing-ie-linaro-org'
         slave_bucket_name = ['publishing-ap-linaro-org']
 
-        master_bucket = self.conn.get_bucket(master_bucket_name,
-                                             validate=False)
+        master_bucket = s3_connection.get_bucket(master_bucket_name)
         master_bucket_keys = master_bucket.list(settings.S3_PREFIX_PATH)
         master_keys = {(key_val.name, key_val.etag) for key_val in
                        master_bucket_keys}
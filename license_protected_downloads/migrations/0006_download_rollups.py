@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 09:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('license_protected_downloads', '0005_download_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadsByCountry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(help_text=b'YYYY.MM', max_length=7)),
+                ('builds', models.IntegerField(default=0)),
+                ('components', models.IntegerField(default=0)),
+                ('country', models.CharField(max_length=256)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DownloadsByName',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(help_text=b'YYYY.MM', max_length=7)),
+                ('builds', models.IntegerField(default=0)),
+                ('components', models.IntegerField(default=0)),
+                ('name', models.CharField(max_length=256)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DownloadsByRegion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(help_text=b'YYYY.MM', max_length=7)),
+                ('builds', models.IntegerField(default=0)),
+                ('components', models.IntegerField(default=0)),
+                ('region_isp', models.CharField(max_length=256)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='downloadsbyregion',
+            unique_together=set([('month', 'region_isp')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='downloadsbyname',
+            unique_together=set([('month', 'name')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='downloadsbycountry',
+            unique_together=set([('month', 'country')]),
+        ),
+    ]
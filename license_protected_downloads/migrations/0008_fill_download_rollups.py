@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+ROLLUPS = (
+    ('DownloadsByName', 'name'),
+    ('DownloadsByCountry', 'country'),
+    ('DownloadsByRegion', 'region_isp'),
+)
+
+
+def fill_rollups(apps, schema_editor):
+    '''Count the downloads recorded before the rollup tables existed.
+
+    The reports only read the rollup tables, this is what
+    models.rebuild_rollups() does with the historical models.
+    '''
+    Download = apps.get_model('license_protected_downloads', 'Download')
+    counts = dict((column, collections.defaultdict(lambda: [0, 0]))
+                  for _, column in ROLLUPS)
+    qs = Download.objects.exclude(country=None).annotate(
+        year=ExtractYear('timestamp'), month=ExtractMonth('timestamp'),
+    ).values(
+        'year', 'month', 'name', 'country', 'region_isp'
+    ).annotate(
+        count=Count('id')
+    ).order_by()
+    for x in qs.iterator():
+        month = '%04d.%02d' % (x['year'], x['month'])
+        split = 1 if 'components' in x['name'] else 0
+        for column, column_counts in counts.items():
+            column_counts[(month, x[column])][split] += x['count']
+
+    for model_name, column in ROLLUPS:
+        model = apps.get_model('license_protected_downloads', model_name)
+        model.objects.all().delete()
+        model.objects.bulk_create(
+            (model(month=month, builds=builds, components=components,
+                   **{column: value})
+             for (month, value), (builds, components)
+             in counts[column].items()),
+            batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('license_protected_downloads', '0007_download_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,22 @@
 import calendar
+import collections
 import datetime
+import hashlib
 import logging
+import threading
 import uuid
-import csv
 import socket
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Count
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Min
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from license_protected_downloads import download_events
+from license_protected_downloads.lru import LRUCache
 
 
 def ip_field(required=True):
@@ -64,6 +73,16 @@ class LicenseManager(models.Manager):
         """
         return self.all().filter(digest__in=hash_list)
 
+    def by_digest(self, digests):
+        """
+        Return a dict of digest to License for the given digests using a
+        single query.
+        """
+        digests = set(digests)
+        if not digests:
+            return {}
+        return dict((x.digest, x) for x in self.filter(digest__in=digests))
+
 
 class License(models.Model):
     digest = models.CharField(max_length=40, unique=True)
@@ -76,6 +95,75 @@ class License(models.Model):
         return self.digest
 
 
+class LicenseRegistry(object):
+    """
+    Process wide record of the license texts and digests we've seen.
+
+    License rows are only ever added with a digest of their text, so once
+    a digest is known to be committed there's no need to query for it
+    again. The set of known digests is loaded from the License table on
+    first use and extended as this process inserts new licenses.
+    """
+
+    def __init__(self, max_texts=256):
+        self._lock = threading.Lock()
+        self._known = None
+        self._texts = LRUCache(max_texts)
+
+    def digest(self, text):
+        digest = self._texts.get(text)
+        if digest is None:
+            digest = hashlib.md5(text).hexdigest()
+            self._texts.set(text, digest)
+        return digest
+
+    def _warm(self):
+        # rows seen inside a transaction might still get rolled back
+        if self._known is None and not connection.in_atomic_block:
+            known = set(License.objects.values_list('digest', flat=True))
+            with self._lock:
+                if self._known is None:
+                    self._known = known
+
+    def _add(self, digest):
+        with self._lock:
+            if self._known is not None:
+                self._known.add(digest)
+
+    def discard(self, digest):
+        with self._lock:
+            if self._known is not None:
+                self._known.discard(digest)
+
+    def clear(self):
+        with self._lock:
+            self._known = None
+        self._texts.clear()
+
+    def register(self, text, theme):
+        """
+        Ensure a License exists for text and return its digest.
+        """
+        digest = self.digest(text)
+        self._warm()
+        if self._known is not None and digest in self._known:
+            return digest
+        # get_or_create copes with another worker inserting the same
+        # digest between its SELECT and INSERT
+        License.objects.get_or_create(
+            digest=digest, defaults={'text': text, 'theme': theme})
+        transaction.on_commit(lambda: self._add(digest))
+        return digest
+
+
+license_registry = LicenseRegistry()
+
+
+@receiver(post_delete, sender=License)
+def _license_deleted(sender, instance, **kwargs):
+    license_registry.discard(instance.digest)
+
+
 class APIKeyStore(models.Model):
     key = models.CharField(max_length=80)
     public = models.BooleanField()
@@ -130,7 +218,8 @@ class APILog(models.Model):
 
 
 class Download(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, report_process sets the time of the download
+    timestamp = models.DateTimeField(default=timezone.now)
     ip = ip_field()
     name = models.CharField(max_length=256)
     link = models.BooleanField(
@@ -140,10 +229,22 @@ class Download(models.Model):
     region_isp = models.CharField(max_length=256, blank=True, null=True)
     ref = models.CharField(max_length=4096, blank=True, null=True)
 
-
-    # this just notes the download request in a giant CSV file.
-    # We then run a report script via cron in order to fill out
-    # the missing details, such as geo ip and all that fun stuff.
+    class Meta:
+        # the reports select a month of downloads, often by one of these
+        # columns, and downloads_report looks for country=None
+        indexes = [
+            models.Index(fields=['timestamp'], name='download_ts_idx'),
+            models.Index(fields=['name', 'timestamp'],
+                         name='download_name_ts_idx'),
+            models.Index(fields=['country', 'timestamp'],
+                         name='download_country_ts_idx'),
+            models.Index(fields=['region_isp', 'timestamp'],
+                         name='download_region_ts_idx'),
+        ]
+
+    # this just notes the download request in CSV files, see
+    # download_events. We then run a report script via cron in order to
+    # fill out the missing details, such as geo ip and all that fun stuff.
     @staticmethod
     def mark(request, artifact):
         try:
@@ -162,9 +263,7 @@ class Download(models.Model):
             http_ref = request.META.get('HTTP_REFERER', '/')
             ref = http_ref.replace('\n', '').replace(',', '')
             timestamp = datetime.datetime.now()
-            with open(settings.REPORT_CSV, "a") as f:
-                writer = csv.writer(f)
-                writer.writerow([ip, name, link, ref[:4096], timestamp])
+            download_events.put([ip, name, link, ref[:4096], timestamp])
         except:
             logging.exception('unable to mark download')
 
@@ -198,3 +297,145 @@ class Download(models.Model):
         ).order_by(
             '-count'
         )
+
+    @staticmethod
+    def month_counts(qs, *columns):
+        '''Count the downloads of qs by month and the given columns.
+
+        Yields (year_month, column values..., count) tuples.
+        '''
+        qs = qs.annotate(
+            year=ExtractYear('timestamp'), month=ExtractMonth('timestamp'),
+        ).values(
+            'year', 'month', *columns
+        ).annotate(
+            count=Count('id')
+        ).order_by()
+        for x in qs.iterator():
+            yield (('%04d.%02d' % (x['year'], x['month']),) +
+                   tuple(x[c] for c in columns) + (x['count'],))
+
+
+class DownloadRollup(models.Model):
+    '''Monthly download counts by the value of one Download column.
+
+    Like Download.report(), only downloads whose location has been filled
+    out are counted. downloads_report adds them as it fills them out.
+    '''
+    month = models.CharField(max_length=7, help_text='YYYY.MM')
+    builds = models.IntegerField(default=0)
+    components = models.IntegerField(default=0)
+
+    # the Download column counted by
+    column = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add(cls, counts):
+        '''Add {(year_month, value): [builds, components]} to the rollup.'''
+        for (month, value), (builds, components) in counts.items():
+            key = {'month': month, cls.column: value}
+            updated = cls.objects.filter(**key).update(
+                builds=F('builds') + builds,
+                components=F('components') + components)
+            if not updated:
+                cls.objects.create(
+                    builds=builds, components=components, **key)
+
+    @classmethod
+    def report(cls, year_month):
+        '''Return the counts for a month like Download.report() does.'''
+        return cls.objects.filter(
+            month=year_month,
+        ).annotate(
+            count=F('builds') + F('components'),
+        ).order_by(
+            '-count'
+        )
+
+
+class DownloadsByName(DownloadRollup):
+    column = 'name'
+    name = models.CharField(max_length=256)
+
+    class Meta:
+        unique_together = ('month', 'name')
+
+
+class DownloadsByCountry(DownloadRollup):
+    column = 'country'
+    country = models.CharField(max_length=256)
+
+    class Meta:
+        unique_together = ('month', 'country')
+
+
+class DownloadsByRegion(DownloadRollup):
+    column = 'region_isp'
+    region_isp = models.CharField(max_length=256)
+
+    class Meta:
+        unique_together = ('month', 'region_isp')
+
+
+ROLLUPS = (DownloadsByName, DownloadsByCountry, DownloadsByRegion)
+
+
+class ArchivedMonth(models.Model):
+    '''A month downloads_archive has moved downloads out of the database for.
+
+    The rollup tables are all that's left of the archived downloads, so
+    rebuild_rollups() leaves these months alone.
+    '''
+    month = models.CharField(max_length=7, unique=True, help_text='YYYY.MM')
+
+
+def _rollup_counts(rows):
+    counts = dict((cls, collections.defaultdict(lambda: [0, 0]))
+                  for cls in ROLLUPS)
+    for month, name, country, region_isp, count in rows:
+        split = 1 if 'components' in name else 0
+        values = {
+            'name': name, 'country': country, 'region_isp': region_isp}
+        for cls in ROLLUPS:
+            counts[cls][(month, values[cls.column])][split] += count
+    return counts
+
+
+def add_to_rollups(rows):
+    '''Add downloads to the rollup tables.
+
+    rows are (year_month, name, country, region_isp, count) tuples.
+    '''
+    for cls, counts in _rollup_counts(rows).items():
+        cls.add(counts)
+
+
+def rebuild_rollups():
+    '''Recount the rollup tables from all the downloads.
+
+    Only the months that have downloads are recounted. Archived months are
+    left as they are, their counts include downloads that are no longer in
+    the database.
+    '''
+    with transaction.atomic():
+        archived = set(ArchivedMonth.objects.values_list('month', flat=True))
+        counts = _rollup_counts(Download.month_counts(
+            Download.objects.exclude(country=None),
+            'name', 'country', 'region_isp'))
+        months = set(month for month, _ in counts[DownloadsByName])
+        months -= archived
+        for cls in ROLLUPS:
+            cls.objects.filter(month__in=months).delete()
+            cls.objects.bulk_create(
+                cls(month=month, builds=builds, components=components,
+                    **{cls.column: value})
+                for (month, value), (builds, components)
+                in counts[cls].items() if month in months)
+
+
+def first_report_month():
+    '''Return the first year_month downloads were counted in, or None.'''
+    return DownloadsByName.objects.aggregate(first=Min('month'))['first']
@@ -1,13 +1,23 @@
 import codecs
+import hashlib
 import os
 import textile
 import OrderedDict
 from django.conf import settings
 
+from license_protected_downloads import dir_index
+from license_protected_downloads.lru import LRUCache
+
 
 HOWTO_PATH = "howto"
 HOWTO_PRODUCT_PATH = "target/product"
 
+# number of rendered files to remember
+RENDERED_SIZE = 256
+
+_rendered = LRUCache(RENDERED_SIZE)
+_MISSING = object()
+
 
 class MultipleFilesException(Exception):
     pass
@@ -39,6 +49,19 @@ class RenderTextFiles:
 
     @classmethod
     def render_buff(cls, buff):
+        '''Return buff rendered as textile, None if that fails.
+
+        textile is slow, so the results are remembered by content digest.
+        '''
+        key = hashlib.md5(buff).hexdigest()
+        html = _rendered.get(key, _MISSING)
+        if html is _MISSING:
+            html = cls._render(buff)
+            _rendered.set(key, html)
+        return html
+
+    @classmethod
+    def _render(cls, buff):
         try:
             buff = codecs.decode(buff, "utf-8")
             return textile.textile(buff)
@@ -104,10 +127,11 @@ class RenderTextFiles:
             directory are added to the list.
         '''
         fileList = []
-        if os.path.exists(path):
-            for file in os.listdir(path):
+        index = dir_index.get(path)
+        if index is not None:
+            for file in index.names:
                 dirfile = os.path.join(path, file)
-                if os.path.isfile(dirfile):
+                if index.isfile(file):
                     if not files_list:
                         fileList.append(dirfile)
                     else:
@@ -143,10 +167,11 @@ class RenderTextFiles:
         """
         howto_path = ""
         path = os.path.join(path, HOWTO_PRODUCT_PATH)
-        if os.path.exists(path):
-            for file in os.listdir(path):
+        index = dir_index.get(path)
+        if index is not None:
+            for file in index.names:
                 product_path = os.path.join(path, file)
-                if os.path.isdir(product_path):
+                if index.isdir(file):
                     howto_path = os.path.join(product_path, HOWTO_PATH)
                     break
 
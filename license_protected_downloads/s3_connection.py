@@ -0,0 +1,113 @@
+'''S3 connections shared by the views and the management commands.
+
+boto connections aren't safe to share between threads, so each thread gets
+its own connection which is kept open and reused for all its requests.
+'''
+import httplib
+import logging
+import socket
+import threading
+import time
+
+import boto
+import boto.exception
+
+from django.conf import settings
+
+log = logging.getLogger("llp.s3")
+
+
+def is_transient(e):
+    '''Return True if the S3 request that raised e is worth retrying.'''
+    if isinstance(e, (httplib.HTTPException, socket.error)):
+        return True
+    if isinstance(e, boto.exception.S3ResponseError):
+        return e.status >= 500
+    return False
+
+
+class S3ConnectionManager(object):
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connect(self):
+        return boto.connect_s3(
+            settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+
+    def _healthy(self, conn):
+        bucket = getattr(settings, 'S3_BUCKET', None)
+        if not bucket:
+            return True
+        try:
+            conn.head_bucket(bucket)
+            return True
+        except Exception:
+            log.warning('S3 connection failed its health check, reconnecting',
+                        exc_info=True)
+            return False
+
+    def connection(self):
+        '''Return this thread's connection, creating it if needed.
+
+        A connection that has been around for S3_HEALTH_CHECK_INTERVAL
+        seconds since it was last checked is tested and replaced if broken.
+        '''
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        now = time.time()
+        if conn is not None and \
+                now - local.checked > settings.S3_HEALTH_CHECK_INTERVAL:
+            local.checked = now
+            if not self._healthy(conn):
+                conn = None
+        if conn is None:
+            conn = local.conn = self._connect()
+            local.buckets = {}
+            local.checked = now
+        return conn
+
+    def get_bucket(self, name=None):
+        '''Return a bucket on this thread's connection.
+
+        name defaults to settings.S3_BUCKET, None is returned if that
+        isn't set.
+        '''
+        if name is None:
+            name = getattr(settings, 'S3_BUCKET', None)
+            if not name:
+                return None
+        conn = self.connection()
+        bucket = self._local.buckets.get(name)
+        if bucket is None:
+            bucket = conn.get_bucket(name, validate=False)
+            self._local.buckets[name] = bucket
+        return bucket
+
+    def reset(self):
+        '''Drop this thread's connection.'''
+        self._local.__dict__.clear()
+
+    def retry(self, func, *args, **kwargs):
+        '''Call func, retrying with an exponential backoff if S3 fails.
+
+        Only errors is_transient() accepts are retried, at most S3_RETRIES
+        times.
+        '''
+        delay = settings.S3_RETRY_BACKOFF
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= settings.S3_RETRIES or not is_transient(e):
+                    raise
+                attempt += 1
+                log.warning('S3 request failed (%r), retry %d in %ss',
+                            e, attempt, delay)
+                time.sleep(delay)
+                delay *= 2
+
+
+manager = S3ConnectionManager()
+get_bucket = manager.get_bucket
+retry = manager.retry
@@ -170,6 +170,38 @@ class APITests(TestCase):
 
             self.assertEqual(mtime, file_info["mtime"])
 
+    def _get_streamed(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(''.join(response.streaming_content))
+
+    def test_api_get_listing_streamed(self):
+        data = self._get_streamed('/api/ls/build-info?stream=1')
+        names = [x['name'] for x in data['files']]
+        self.assertEqual(sorted(names), names)
+        self.assertNotIn('next_marker', data)
+
+        listing = json.loads(
+            self.client.get('/api/ls/build-info').content)['files']
+        self.assertEqual(sorted(listing), sorted(data['files']))
+
+    def test_api_get_listing_paged(self):
+        expected = self._get_streamed('/api/ls/build-info?stream=1')['files']
+        files = []
+        url = '/api/ls/build-info?limit=3'
+        while True:
+            data = self._get_streamed(url)
+            self.assertTrue(len(data['files']) <= 3)
+            files.extend(data['files'])
+            if 'next_marker' not in data:
+                break
+            url = '/api/ls/build-info?limit=3&marker=' + data['next_marker']
+        self.assertEqual(expected, files)
+
+    def test_api_get_listing_bad_limit(self):
+        response = self.client.get('/api/ls/build-info?limit=0')
+        self.assertEqual(response.status_code, 400)
+
     def test_api_get_listing_404(self):
         url = "/api/ls/buld-info"
         response = self.client.get(url)
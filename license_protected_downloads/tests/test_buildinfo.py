@@ -1,10 +1,14 @@
 __author__ = 'dooferlad'
 
+import fnmatch
 import os
 import shutil
 import tempfile
 import unittest
 
+import mock
+
+from license_protected_downloads import buildinfo
 from license_protected_downloads.buildinfo import (
     BuildInfoBase,
     BuildInfo,
@@ -285,5 +289,102 @@ class FileNameMatchingTests(unittest.TestCase):
             self.assertEqual('open', file_info[0]['license-type'])
 
 
+class ParsedCacheTests(unittest.TestCase):
+    content = (
+        "Format-Version: 2.0\n\n"
+        "Files-Pattern: *.txt, *.img\n"
+        "License-Type: protected\n"
+        "Files-Pattern: *.txt\n"
+        "License-Type: open\n"
+        "Files-Pattern: MD5SUM\n"
+        "License-Type: open\n")
+
+    def setUp(self):
+        buildinfo._parsed.clear()
+
+    def test_parsed_once(self):
+        with mock.patch.object(
+                BuildInfoBase, 'parseData',
+                side_effect=BuildInfoBase.parseData, autospec=True) as parse:
+            buildinfo.from_buffer('a/b.txt', self.content)
+            buildinfo.from_buffer('a/MD5SUM', self.content)
+            buildinfo.from_buffer('', self.content)
+            self.assertEqual(1, parse.call_count)
+
+    def test_per_file(self):
+        bi = buildinfo.from_buffer('a/b.txt', self.content)
+        self.assertEqual('b.txt', bi.fname)
+        self.assertEqual([{'license-type': 'protected'}], bi.file_info_array)
+        self.assertIs(bi, buildinfo.from_buffer('c/b.txt', self.content))
+
+        bi = buildinfo.from_buffer('MD5SUM', self.content)
+        self.assertEqual('open', bi.get('license-type'))
+        self.assertFalse(buildinfo.from_buffer('foo', self.content).get(
+            'license-type'))
+
+    def test_shared_parse_not_modified(self):
+        '''remove_false_positives must not change the shared document'''
+        first = buildinfo.from_buffer('b.txt', self.content)
+        self.assertEqual(1, first.max_index)
+        bi = BuildInfoBase('b.txt', self.content)
+        self.assertEqual(bi.build_info_array, first.build_info_array)
+        self.assertEqual(
+            2, len(first.build_info_array[0]['*.txt']))
+
+
+class MatcherTests(unittest.TestCase):
+    def _fnmatch_info(self, build_info_array, fname):
+        # the matching getInfoForFile did before it was compiled
+        for block in build_info_array:
+            if fname in block:
+                return block[fname]
+            for key in block:
+                if key != 'format-version':
+                    if fnmatch.fnmatch(fname, key):
+                        return block[key]
+        return [{}]
+
+    def test_same_as_fnmatch(self):
+        patterns = ['*.txt', 'a*', '*.img', 'boot.img', '[ab]?.tar.*',
+                    'foo[!0-9]', 'x.txt', '*']
+        names = ['x.txt', 'a.txt', 'boot.img', 'ab.tar.gz', 'foox',
+                 'foo1', 'a\nb', 'MD5SUM', '.hidden']
+        for i in range(len(patterns)):
+            block = {'format-version': '2.0'}
+            for x in patterns[i:]:
+                block[x] = [{'license-type': x}]
+            matcher = buildinfo.Matcher([block])
+            for name in names:
+                self.assertIs(self._fnmatch_info([block], name),
+                              matcher.match(name))
+
+    def test_many_patterns(self):
+        block = dict(('f%d*' % x, [{'n': x}]) for x in range(250))
+        matcher = buildinfo.Matcher([block])
+        for x in range(250):
+            name = 'f%d.txt' % x
+            self.assertIs(self._fnmatch_info([block], name),
+                          matcher.match(name))
+        self.assertEqual([{}], matcher.match('g1'))
+
+    def test_match_many(self):
+        block = {'*.txt': [{'a': 1}], 'b.img': [{'b': 2}]}
+        matcher = buildinfo.Matcher([block])
+        self.assertEqual(
+            {'a.txt': [{'a': 1}], 'b.img': [{'b': 2}], 'c': [{}]},
+            matcher.match_many(['a.txt', 'b.img', 'c']))
+
+    def test_for_files(self):
+        content = ("Format-Version: 2.0\n\n"
+                   "Files-Pattern: *.txt\n"
+                   "License-Type: open\n")
+        doc = BuildInfoBase('', content)
+        bis = doc.for_files(['x/a.txt', 'b.img'])
+        self.assertEqual('a.txt', bis['x/a.txt'].fname)
+        self.assertEqual('open', bis['x/a.txt'].get('license-type'))
+        self.assertFalse(bis['b.img'].get('license-type'))
+        self.assertIs(bis['x/a.txt'], doc.for_file('a.txt'))
+
+
 if __name__ == '__main__':
     unittest.main()
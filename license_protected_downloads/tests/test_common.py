@@ -4,9 +4,34 @@ import os
 import tempfile
 import unittest
 
-from license_protected_downloads.artifact import LocalArtifact
-from license_protected_downloads.artifact.base import _sizeof_fmt, cached_prop
-from license_protected_downloads.common import _sort_artifacts
+from django.core.cache import cache
+from django.http import Http404
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+
+import boto.s3.key
+import boto.s3.prefix
+import mock
+
+from license_protected_downloads import (
+    common,
+    dir_index,
+    models,
+    wildcard,
+)
+from license_protected_downloads.artifact import LocalArtifact, S3Artifact
+from license_protected_downloads.artifact import base
+from license_protected_downloads.artifact.base import (
+    _sizeof_fmt,
+    _ThemeLicenses,
+    cached_prop,
+    extract_content,
+)
+from license_protected_downloads.tests.helpers import temporary_directory
 from license_protected_downloads.tests.test_views import TESTSERVER_ROOT
 
 
@@ -27,9 +52,18 @@ class CommonTests(unittest.TestCase):
         for files, expected in patterns:
             artifacts = [LocalArtifact(None, '', x, True, '')
                          for x in files]
-            artifacts.sort(_sort_artifacts)
+            artifacts.sort(
+                key=lambda x: common.listing_sort_key(x.file_name))
             self.assertEqual(expected, [x.file_name for x in artifacts])
 
+    def test_listing_sort_key(self):
+        names = ['foo', '16.12', 'latest', '9', 'inf', '17.01', 'nan',
+                 '10', '.hidden', '10.0']
+        self.assertEqual(
+            ['latest', '17.01', '16.12', '10', '10.0', '9', '.hidden',
+             'foo', 'inf', 'nan'],
+            sorted(names, key=common.listing_sort_key))
+
     def test_cached_property(self):
         class Foo(object):
             def __init__(self):
@@ -46,6 +80,357 @@ class CommonTests(unittest.TestCase):
         self.assertEqual(0, f.bar)
 
 
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+})
+class CachedCallTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def lookup(self, request, path):
+        self.calls.append(path)
+        if path == 'missing':
+            request.path = 'Multiple files match this expression'
+            raise Http404
+        return path.upper()
+
+    def test_cached(self):
+        request = RequestFactory().get('/foo')
+        self.assertEqual('FOO', common.cached_call(
+            request, 'foo', self.lookup, request, 'foo'))
+        self.assertEqual('FOO', common.cached_call(
+            request, 'foo', self.lookup, request, 'foo'))
+        self.assertEqual(['foo'], self.calls)
+
+    def test_key_includes_api_key(self):
+        for url in ('/foo', '/foo?key=a', '/foo?key=b', '/foo?key=a'):
+            request = RequestFactory().get(url)
+            common.cached_call(request, 'foo', self.lookup, request, 'foo')
+        self.assertEqual(3, len(self.calls))
+
+    def test_key_includes_served_paths(self):
+        request = RequestFactory().get('/foo')
+        common.cached_call(request, 'foo', self.lookup, request, 'foo')
+        with self.settings(SERVED_PATHS=['/somewhere/else']):
+            common.cached_call(request, 'foo', self.lookup, request, 'foo')
+        self.assertEqual(2, len(self.calls))
+
+    def test_not_found_cached(self):
+        for x in range(2):
+            request = RequestFactory().get('/missing')
+            with self.assertRaises(Http404):
+                common.cached_call(
+                    request, 'missing', self.lookup, request, 'missing')
+            self.assertEqual(
+                'Multiple files match this expression', request.path)
+        self.assertEqual(['missing'], self.calls)
+
+    def test_stats(self):
+        def counted(request, path):
+            return path
+        request = RequestFactory().get('/foo')
+        for x in range(3):
+            common.cached_call(request, 'foo', counted, request, 'foo')
+        self.assertEqual(
+            {'hit': 2, 'miss': 1}, common.cache_stats()['counted'])
+
+
+class DirListLicenseTests(TestCase):
+    def test_single_license_query(self):
+        a = LocalArtifact(None, '/', 'build-info', False, TESTSERVER_ROOT)
+        expected = dict(
+            (x.file_name, list(models.License.objects.all_with_hashes(
+                x.license_digest_list)))
+            for x in [LocalArtifact(a, '/build-info/', y, False, a.full_path)
+                      for y in os.listdir(a.full_path)])
+
+        a = LocalArtifact(None, '/', 'build-info', False, TESTSERVER_ROOT)
+        with mock.patch.object(models.License.objects, 'all_with_hashes') \
+                as all_with_hashes, \
+                mock.patch.object(models.License.objects, 'by_digest',
+                                  wraps=models.License.objects.by_digest) \
+                as by_digest:
+            listing = common.dir_list(a)
+        self.assertFalse(all_with_hashes.called)
+        self.assertEqual(1, by_digest.call_count)
+
+        self.assertTrue(any(x['license_list'] for x in listing))
+        for entry in listing:
+            self.assertEqual(expected[entry['name']], entry['license_list'])
+
+
+class DirListTests(TestCase):
+    def _listing(self, parent, human_readable):
+        # the listing dir_list used to produce from an artifact per file
+        listing = []
+        for x in sorted(os.listdir(parent.full_path)):
+            a = LocalArtifact(parent, parent.url(), x, human_readable,
+                              parent.full_path)
+            if not a.hidden():
+                listing.append(a.get_listing())
+        return listing
+
+    def test_same_as_artifacts(self):
+        dirs = ['', 'build-info', 'images', 'protected_listing',
+                '~linaro-android/staging-origen',
+                '~linaro-android/staging-snowball', 'broken-symlinks']
+        for path in dirs:
+            for human_readable in (True, False):
+                parent = LocalArtifact(
+                    None, '', path, human_readable, TESTSERVER_ROOT)
+                expected = dict(
+                    (x.name, x) for x in self._listing(parent, human_readable))
+                with mock.patch.object(
+                        LocalArtifact, '__init__', side_effect=AssertionError):
+                    listing = common.dir_list(parent, human_readable)
+                self.assertEqual(sorted(expected), sorted(
+                    x.name for x in listing))
+                for entry in listing:
+                    exp = expected[entry.name]
+                    for k in ('name', 'size', 'mtime', 'type', 'url',
+                              'license_digest_list'):
+                        self.assertEqual(exp[k], entry[k])
+                    self.assertEqual(
+                        list(exp.license_list), entry.license_list)
+
+    def test_entry(self):
+        entry = common.dir_list(
+            LocalArtifact(None, '', 'images', False, TESTSERVER_ROOT))[0]
+        self.assertFalse(hasattr(entry, '__dict__'))
+        self.assertEqual(entry.name, entry['name'])
+        with self.assertRaises(KeyError):
+            entry['file_name']
+
+
+@override_settings(S3_PREFIX_PATH='p/')
+class IterDirListTests(SimpleTestCase):
+    def setUp(self):
+        bucket = mock.Mock()
+
+        def list(delimiter, prefix, marker=''):
+            # S3Artifact modifies the items, so hand out new ones each time
+            keys = []
+            for name in ('p/x/a', 'p/x/a-b', 'p/x/BUILD-INFO.txt', 'p/x/e'):
+                key = boto.s3.key.Key(bucket, name)
+                key.size = 1
+                key.last_modified = '2017-01-01T00:00:00.000Z'
+                keys.append(key)
+            keys.insert(2, boto.s3.prefix.Prefix(bucket, 'p/x/a/'))
+            return [x for x in keys if x.name > marker]
+        bucket.list.side_effect = list
+        self.bucket = bucket
+        mocked = mock.patch.object(S3Artifact, 'get_bucket',
+                                   return_value=bucket)
+        mocked.start()
+        self.addCleanup(mocked.stop)
+
+    def test_merged(self):
+        with temporary_directory() as tmp:
+            tmp.make_file('x/a', 'local')
+            tmp.make_file('x/b', 'local')
+            parent = LocalArtifact(None, '', 'x', False, tmp.root)
+            entries = list(common.iter_dir_list(parent, False))
+            self.assertEqual(['a', 'a-b', 'a/', 'b', 'e'],
+                             [common.listing_marker(x) for x in entries])
+            self.assertEqual(5, entries[0].size)
+
+            entries = list(common.iter_dir_list(parent, False, 'a-b'))
+            self.assertEqual(['a/', 'b', 'e'],
+                             [common.listing_marker(x) for x in entries])
+            self.assertEqual({'delimiter': '/', 'prefix': 'p/x/',
+                              'marker': 'p/x/a-b'},
+                             self.bucket.list.call_args[1])
+
+
+class ThemeLicensesTests(SimpleTestCase):
+    def test_revalidated_by_mtime(self):
+        with temporary_directory() as tmp:
+            path = tmp.make_file('templates/licenses/foo.txt', 'v1')
+            os.utime(path, (1500, 1500))
+            licenses = _ThemeLicenses()
+            with override_settings(PROJECT_ROOT=tmp.root), \
+                    mock.patch('time.time') as now:
+                now.return_value = 1000
+                self.assertEqual('v1', licenses.get('foo'))
+
+                with open(path, 'w') as f:
+                    f.write('v2')
+                os.utime(path, (1500, 1500))
+                now.return_value = 1100
+                with mock.patch('__builtin__.open') as mock_open:
+                    self.assertEqual('v1', licenses.get('foo'))
+                    self.assertFalse(mock_open.called)
+
+                os.utime(path, (1510, 1510))
+                now.return_value = 1101
+                self.assertEqual('v1', licenses.get('foo'))
+                now.return_value = 1200
+                self.assertEqual('v2', licenses.get('foo'))
+
+
+class WildcardTests(SimpleTestCase):
+    def setUp(self):
+        dir_index.clear()
+
+    def test_first_matches(self):
+        names = ['a.img', 'b.img.gz', 'b.img', 'c.img', 'b.txt']
+        self.assertEqual(['b.img', 'b.txt'],
+                         wildcard.first_matches(names, 'b.*[!z]'))
+        self.assertEqual(['a.img'],
+                         wildcard.first_matches(names, '*.img', limit=1))
+        self.assertEqual([], wildcard.first_matches(names, 'd*'))
+        self.assertEqual('b.', wildcard.literal_prefix('b.*[!z]'))
+
+    def test_handle_wildcard(self):
+        request = RequestFactory().get('/')
+        with temporary_directory() as tmp:
+            tmp.make_file('a.img.gz', 'a')
+            tmp.make_file('b.img.gz', 'b')
+            path = os.path.join(tmp.root, 'a*.gz')
+            self.assertEqual(os.path.join(tmp.root, 'a.img.gz'),
+                             common._handle_wildcard(request, path))
+            with self.assertRaises(Http404):
+                common._handle_wildcard(
+                    request, os.path.join(tmp.root, '*.gz'))
+            self.assertIsNone(common._handle_wildcard(
+                request, os.path.join(tmp.root, 'c*.gz')))
+
+    def test_cached_per_mtime(self):
+        with temporary_directory() as tmp:
+            tmp.make_file('a.img.gz', 'a')
+            os.utime(tmp.root, (1000, 1000))
+            self.assertEqual(['a.img.gz'],
+                             wildcard.match_dir(tmp.root, '*.gz'))
+            with mock.patch('os.listdir') as listdir:
+                self.assertEqual(['a.img.gz'],
+                                 wildcard.match_dir(tmp.root, '*.gz'))
+                self.assertFalse(listdir.called)
+
+            tmp.make_file('b.img.gz', 'b')
+            os.utime(tmp.root, (1010, 1010))
+            self.assertEqual(['a.img.gz', 'b.img.gz'],
+                             sorted(wildcard.match_dir(tmp.root, '*.gz')))
+
+
+class DirIndexTests(SimpleTestCase):
+    def setUp(self):
+        dir_index.clear()
+
+    def test_index(self):
+        with temporary_directory() as tmp:
+            tmp.make_file('BUILD-INFO.txt', 'x')
+            tmp.make_file('EULA.txt', 'x')
+            tmp.make_file('EULA.txt.theme', 'x')
+            tmp.make_file('.EULA.txt', 'x')
+            tmp.make_file('sub/file', 'x')
+            os.symlink('nothing', os.path.join(tmp.root, 'broken'))
+
+            index = dir_index.get(tmp.root)
+            self.assertEqual(['EULA.txt', 'EULA.txt.theme'],
+                             sorted(index.eulas))
+            self.assertTrue(index.isfile('BUILD-INFO.txt'))
+            self.assertTrue(index.isdir('sub'))
+            self.assertFalse(index.exists('broken'))
+            self.assertIsNone(dir_index.lookup(tmp.root + '/broken'))
+            self.assertIsNone(dir_index.lookup(tmp.root + '/sub/nope'))
+            self.assertTrue(dir_index.lookup(tmp.root + '/sub/file'))
+            self.assertIsNone(dir_index.get(tmp.root + '/sub/file'))
+
+    @override_settings(LOCAL_INDEX_TIMEOUT=60)
+    def test_revalidated(self):
+        with temporary_directory() as tmp:
+            tmp.make_file('a', 'x')
+            os.utime(tmp.root, (1000, 1000))
+            with mock.patch('time.time', return_value=2000):
+                index = dir_index.get(tmp.root)
+            with mock.patch('time.time', return_value=2030):
+                self.assertIs(index, dir_index.get(tmp.root))
+            # files changed in place are noticed after a timeout
+            with mock.patch('time.time', return_value=2070):
+                self.assertIsNot(index, dir_index.get(tmp.root))
+
+            tmp.make_file('b', 'x')
+            self.assertEqual(['a', 'b'], sorted(dir_index.get(tmp.root).names))
+
+    @override_settings(LOCAL_INDEX_TIMEOUT=60)
+    def test_lookup(self):
+        with temporary_directory() as tmp:
+            tmp.make_file('a', 'x')
+            # no index is built to look up one entry
+            self.assertTrue(dir_index.lookup(tmp.root + '/a'))
+            self.assertIsNone(dir_index._indexes.get(tmp.root))
+
+            # but a valid one is used
+            os.utime(tmp.root, (1000, 1000))
+            with mock.patch('time.time', return_value=2000):
+                self.assertTrue(dir_index.get(tmp.root).exists('a'))
+            os.remove(os.path.join(tmp.root, 'a'))
+            os.utime(tmp.root, (1000, 1000))
+            with mock.patch('time.time', return_value=2030):
+                self.assertTrue(dir_index.lookup(tmp.root + '/a'))
+            with mock.patch('time.time', return_value=2070):
+                self.assertIsNone(dir_index.lookup(tmp.root + '/a'))
+
+    def test_lazy_stats(self):
+        with temporary_directory() as tmp:
+            for name in ('a', 'b', 'c'):
+                tmp.make_file(name, 'x')
+            with mock.patch('os.stat', wraps=os.stat) as st:
+                index = dir_index.get(tmp.root)
+                # only the directory itself
+                self.assertEqual(1, st.call_count)
+                self.assertTrue(index.isfile('a'))
+                self.assertTrue(index.exists('a'))
+                self.assertFalse(index.exists('nope'))
+                self.assertEqual(2, st.call_count)
+
+    def test_cached_bounded(self):
+        with temporary_directory() as tmp:
+            index = dir_index.get(tmp.root)
+            for i in range(dir_index.DERIVED_SIZE + 1):
+                index.cached(i, lambda i: i, i)
+            self.assertEqual(dir_index.DERIVED_SIZE, len(index._derived))
+            self.assertEqual('x', index.cached(0, lambda: 'x'))
+
+    def test_recent_change_not_reused(self):
+        with temporary_directory() as tmp:
+            index = dir_index.get(tmp.root)
+            self.assertIsNot(index, dir_index.get(tmp.root))
+
+
+class ExtractContentTests(unittest.TestCase):
+    def test_nested(self):
+        body = ('<html><body><div id="head">x</div>'
+                '<div id="content">\n<div>a</div><p>b</p>\n</div>'
+                '<div>c</div></body></html>')
+        self.assertEqual('<div>a</div><p>b</p>', extract_content(body))
+
+    def test_unclosed(self):
+        body = '<body><div id="content"><h2>a</h2>\n</body></html>'
+        self.assertEqual('<h2>a</h2>', extract_content(body))
+        body = '<div id="content"><h2>a</h2>'
+        self.assertEqual('<h2>a</h2>', extract_content(body))
+
+    def test_multiple(self):
+        body = '<p id="content">a</p><p>b</p><span id="content">c</span>'
+        self.assertEqual('ac', extract_content(body))
+
+    def test_encoding(self):
+        self.assertEqual(u'caf\xe9', extract_content(
+            '<div id="content">caf\xc3\xa9</div>'))
+        self.assertEqual(u'caf\xe9', extract_content(
+            '<div id="content">caf\xe9</div>'))
+
+    def test_other_line_breaks(self):
+        # only '\n' starts a new line for the parser's positions
+        body = (u'<html>\r<head>\x0c</head>\r\n<body>\x0b\u2028\n'
+                u'<div id="content">a\x0c<p>b</p>\rc</div>\n</body></html>')
+        self.assertEqual(u'a\x0c<p>b</p>\rc', extract_content(body))
+
+
 class ArtifactTests(unittest.TestCase):
     def setUp(self):
         self.artifact = LocalArtifact(
@@ -63,6 +448,37 @@ class ArtifactTests(unittest.TestCase):
         self.addCleanup(os.unlink, tmp_filename)
         return os.path.basename(tmp_filename)
 
+    def test_single_stat(self):
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            a = LocalArtifact(None, '/', 'build-info', False, TESTSERVER_ROOT)
+            self.assertTrue(a.isdir())
+            self.assertEqual('/build-info/', a.url())
+            self.assertEqual('folder', a.get_type())
+        self.assertEqual(1, stat.call_count)
+
+        st = os.stat(os.path.join(TESTSERVER_ROOT, 'README'))
+        with mock.patch('os.stat') as stat:
+            a = LocalArtifact(None, '/', 'README', False, TESTSERVER_ROOT, st)
+            self.assertFalse(a.isdir())
+        self.assertFalse(stat.called)
+        self.assertEqual(st.st_size, a.size)
+        self.assertEqual(st.st_mtime, a.mtime)
+
+    def test_broken_symlink(self):
+        a = LocalArtifact(None, '/broken-symlinks', 'nothing', False,
+                          os.path.join(TESTSERVER_ROOT, 'broken-symlinks'))
+        self.assertFalse(a.isdir())
+        self.assertEqual(0, a.size)
+
+    def test_header_html_cached(self):
+        base._headers.clear()
+        with mock.patch.object(base, 'extract_content',
+                               wraps=base.extract_content) as extract:
+            html = self.artifact.get_header_html()
+            self.assertIn('Included from README', html)
+            self.assertEqual(html, self.artifact.get_header_html())
+        self.assertEqual(1, extract.call_count)
+
     def test_replace_self_closing_tag(self):
         ret = self.artifact._process_include_tags(
             'Test <linaro:include file="README" /> html')
@@ -1,10 +1,32 @@
 #!/usr/bin/env python
 
+import csv
+import datetime
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import mock
+
 import license_protected_downloads.management.commands.setsuperuser \
    as setsuperuser
+from license_protected_downloads.management.commands import (
+    downloads_archive,
+    report_process,
+)
+from license_protected_downloads.models import (
+    ArchivedMonth,
+    Download,
+    DownloadsByName,
+    add_to_rollups,
+    rebuild_rollups,
+)
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TestCase
+from django.db import DataError, DatabaseError, IntegrityError
+from django.test import TestCase, override_settings
 
 
 class SetsuperuserCommandTest(TestCase):
@@ -24,3 +46,231 @@ class SetsuperuserCommandTest(TestCase):
         user = User.objects.get(username="existing_user")
         self.assertEquals(user.is_staff, True)
         self.assertEquals(user.is_superuser, True)
+
+
+class ReportProcessTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.name = os.path.join(self.tmp, 'report_1.csv')
+        with open(self.name, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['1.1.1.1', '/a', 'False', '/',
+                             '2018-03-15 10:37:01.000123'])
+            writer.writerow(['1.1.1.2', '/b\n', 'True', '/',
+                             '2018-03-15 10:37:02'])
+            writer.writerow(['1.1.1.3', '/c', 'False', '/', 'yesterday'])
+            writer.writerow(['1.1.1.4', '/d', 'False', '/'])
+            writer.writerow(['1.1.1.5', '/e', 'False', '/',
+                             '2018-03-15 10:37:05'])
+
+    def test_parse_timestamp(self):
+        self.assertEqual(datetime.datetime(2018, 3, 15, 10, 37, 1, 123),
+                         report_process.parse_timestamp(
+                             '2018-03-15 10:37:01.000123'))
+        self.assertEqual(datetime.datetime(2018, 3, 15, 10, 37, 1),
+                         report_process.parse_timestamp(
+                             '2018-03-15 10:37:01'))
+        self.assertEqual(datetime.datetime(2018, 3, 15, 10, 37, 1, 500000),
+                         report_process.parse_timestamp(
+                             '2018-03-15 10:37:01.5'))
+        self.assertRaises(ValueError, report_process.parse_timestamp,
+                          '2018-13-15 10:37:01')
+
+    @mock.patch.object(report_process, 'logging')
+    def test_process_file(self, logging):
+        report_process.process_file(self.name, batch_size=2)
+        self.assertFalse(os.path.exists(self.name))
+        self.assertFalse(os.path.exists(self.name + '.offset'))
+
+        downloads = Download.objects.order_by('ip')
+        self.assertEqual(['/a', '/b', '/d', '/e'],
+                         [x.name for x in downloads])
+        self.assertEqual(datetime.datetime(2018, 3, 15, 10, 37, 1, 123),
+                         downloads[0].timestamp)
+        self.assertTrue(downloads[1].link)
+        self.assertEqual(1, logging.error.call_count)
+
+    def test_resume(self):
+        with open(self.name) as f:
+            f.readline()
+            f.readline()
+            f.readline()  # the newline in "/b" spans two lines
+            report_process.write_checkpoint(self.name, f.tell())
+        with mock.patch.object(report_process, 'logging'):
+            report_process.process_file(self.name, batch_size=2)
+        self.assertEqual(['/d', '/e'], [
+            x.name for x in Download.objects.order_by('ip')])
+
+    def test_checkpoint_per_batch(self):
+        with mock.patch.object(report_process, 'insert_batch',
+                               side_effect=[None, DatabaseError]), \
+                mock.patch.object(report_process, 'logging'):
+            with self.assertRaises(DatabaseError):
+                report_process.process_file(self.name, batch_size=2)
+        self.assertTrue(os.path.exists(self.name))
+        with open(self.name) as f:
+            f.seek(report_process.read_checkpoint(self.name))
+            self.assertEqual('1.1.1.3', next(csv.reader(f))[0])
+
+    @mock.patch.object(report_process, 'logging')
+    def test_batch_rejected(self, logging):
+        save = Download.save
+
+        def _save(download, *args, **kwargs):
+            if download.name == '/b':
+                raise DataError('too long')
+            return save(download, *args, **kwargs)
+
+        with mock.patch.object(Download.objects, 'bulk_create',
+                               side_effect=DataError), \
+                mock.patch.object(Download, 'save', autospec=True,
+                                  side_effect=_save):
+            report_process.process_file(self.name, batch_size=10)
+        self.assertEqual(['/a', '/d', '/e'], [
+            x.name for x in Download.objects.order_by('ip')])
+        self.assertEqual(1, logging.warning.call_count)
+
+    @mock.patch.object(report_process, 'logging')
+    def test_row_integrity_error(self, logging):
+        save = Download.save
+
+        def _save(download, *args, **kwargs):
+            if download.name == '/b':
+                raise IntegrityError('null value')
+            return save(download, *args, **kwargs)
+
+        with mock.patch.object(Download.objects, 'bulk_create',
+                               side_effect=IntegrityError), \
+                mock.patch.object(Download, 'save', autospec=True,
+                                  side_effect=_save):
+            report_process.process_file(self.name, batch_size=10)
+        self.assertEqual(['/a', '/d', '/e'], [
+            x.name for x in Download.objects.order_by('ip')])
+        self.assertFalse(os.path.exists(self.name))
+
+    def test_checkpoint_last_batch(self):
+        with mock.patch.object(report_process.os, 'remove',
+                               side_effect=OSError), \
+                mock.patch.object(report_process, 'logging'):
+            with self.assertRaises(OSError):
+                report_process.process_file(self.name, batch_size=2)
+        self.assertEqual(os.path.getsize(self.name),
+                         report_process.read_checkpoint(self.name))
+        with mock.patch.object(report_process, 'logging'):
+            report_process.process_file(self.name, batch_size=2)
+        self.assertEqual(4, Download.objects.count())
+
+    def test_copy_quotes_empty_fields(self):
+        copied = []
+        with mock.patch.object(report_process, 'connection') as conn:
+            conn.ops.quote_name.side_effect = lambda x: '"%s"' % x
+            cursor = conn.cursor.return_value.__enter__.return_value
+            cursor.copy_expert.side_effect = \
+                lambda sql, buf: copied.append(buf.getvalue())
+            report_process._copy([Download(
+                ip='', name='/a', link=False, ref='',
+                timestamp=datetime.datetime(2018, 3, 15))])
+        self.assertEqual(
+            '"2018-03-15 00:00:00","","/a","False",""\r\n', copied[0])
+
+
+class DownloadsArchiveTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        override = override_settings(DOWNLOAD_ARCHIVE_DIR=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+        downloads = [
+            ('1.1.1.1', u'/a\u00e9', datetime.datetime(2018, 2, 10), 'AA'),
+            ('1.1.1.2', '/b', datetime.datetime(2018, 2, 28, 23, 59), 'BB'),
+            ('1.1.1.1', '/a', datetime.datetime(2018, 3, 1), 'AA'),
+            ('1.1.1.3', '/c', datetime.datetime(2018, 4, 1), None),
+        ]
+        for ip, name, ts, country in downloads:
+            Download.objects.create(
+                ip=ip, name=name, link=False, timestamp=ts, country=country,
+                region_isp=country and 'r / i')
+
+    @staticmethod
+    def _downloads():
+        return sorted(Download.objects.values_list(
+            'timestamp', 'ip', 'name', 'link', 'country', 'region_isp',
+            'ref'))
+
+    def test_closed_months(self):
+        with mock.patch.object(downloads_archive, 'datetime') as dt:
+            dt.datetime.now.return_value = datetime.datetime(2018, 6, 15)
+            self.assertEqual(['2018.02', '2018.03'],
+                             downloads_archive.closed_months(2))
+            self.assertEqual([], downloads_archive.closed_months(4))
+
+    def test_archive_restore(self):
+        before = self._downloads()
+        rebuild_rollups()
+        stdout = StringIO()
+        call_command('downloads_archive', '2018.02', '2018.04', '2018.05',
+                     stdout=stdout)
+        self.assertEqual(['/a', '/c'], sorted(
+            Download.objects.values_list('name', flat=True)))
+        self.assertEqual(['downloads-2018.02.1.csv.gz'], os.listdir(self.tmp))
+        self.assertIn('Archived 2 downloads of 2018.02', stdout.getvalue())
+        self.assertIn('Skipping 2018.04', stdout.getvalue())
+
+        # the counts of archived months are kept
+        rebuild_rollups()
+        self.assertEqual(['2018.02', '2018.02', '2018.03'], sorted(
+            DownloadsByName.objects.values_list('month', flat=True)))
+
+        call_command('downloads_archive', '2018.02', restore=True,
+                     stdout=stdout)
+        self.assertEqual(before, self._downloads())
+        self.assertEqual([], os.listdir(self.tmp))
+
+    def test_archive_twice(self):
+        before = self._downloads()
+        self.assertEqual(2, downloads_archive.archive_month('2018.02'))
+        # a late download for a month that has been archived
+        Download.objects.create(
+            ip='1.1.1.4', name='/d', link=True, country='DD',
+            region_isp='r / i', timestamp=datetime.datetime(2018, 2, 11))
+        late = self._downloads()
+        self.assertEqual(1, downloads_archive.archive_month('2018.02'))
+        self.assertEqual(['downloads-2018.02.1.csv.gz',
+                          'downloads-2018.02.2.csv.gz'],
+                         sorted(os.listdir(self.tmp)))
+
+        self.assertEqual(3, downloads_archive.restore_month('2018.02'))
+        self.assertEqual(sorted(set(before + late)), self._downloads())
+        self.assertEqual([], os.listdir(self.tmp))
+
+    def test_rebuild_keeps_archived_counts(self):
+        rebuild_rollups()
+        downloads_archive.archive_month('2018.2')
+        self.assertEqual(['2018.02'], list(
+            ArchivedMonth.objects.values_list('month', flat=True)))
+
+        # a late download, counted as downloads_report fills it out
+        Download.objects.create(
+            ip='1.1.1.4', name='/b', link=False, country='BB',
+            region_isp='r / i', timestamp=datetime.datetime(2018, 2, 11))
+        add_to_rollups([('2018.02', '/b', 'BB', 'r / i', 1)])
+        rebuild_rollups()
+        self.assertEqual([(u'/a\u00e9', 1), ('/b', 2)], sorted(
+            DownloadsByName.objects.filter(month='2018.02').values_list(
+                'name', 'builds')))
+
+        # once restored the month is recounted from the database
+        downloads_archive.restore_month('2018.02')
+        self.assertFalse(ArchivedMonth.objects.exists())
+        rebuild_rollups()
+        self.assertEqual([(u'/a\u00e9', 1), ('/b', 2)], sorted(
+            DownloadsByName.objects.filter(month='2018.02').values_list(
+                'name', 'builds')))
+
+    def test_restore_errors(self):
+        with self.assertRaises(CommandError):
+            downloads_archive.restore_month('2018.02')
+        with self.assertRaises(CommandError):
+            downloads_archive.restore_month('2018-02')
@@ -1,8 +1,13 @@
 import datetime
+import importlib
 
+import mock
+from django.apps import apps
 from django.test import TestCase
 
+from license_protected_downloads import models
 from license_protected_downloads.models import Download
+from license_protected_downloads.management.commands import downloads_report
 from license_protected_downloads.management.commands.downloads_report import (
     Command,
 )
@@ -31,7 +36,7 @@ class TestDownloadsCommand(TestCase):
         _create_download('1.1.1.2', '/foo/BAR', 1)
         _create_download('1.1.1.2', '/foo/BAR', 0)  # dup
 
-        self.assertEqual([2, 4, 7], Command()._find_dups())
+        self.assertEqual([2, 4, 7], sorted(Command()._find_dups()))
 
     def test_remove_dups(self):
         _create_download('1.1.1.1', '/foo/bar', 4)
@@ -41,3 +46,119 @@ class TestDownloadsCommand(TestCase):
 
         Command()._remove_dups([1, 2])
         self.assertEqual([3, 4], [x.id for x in Download.objects.all()])
+
+    def test_remove_dups_chunked(self):
+        for i in range(5):
+            _create_download('1.1.1.1', '/foo/bar', 4 - i)
+
+        with mock.patch.object(downloads_report, 'CHUNK_SIZE', 2):
+            Command()._remove_dups(iter([1, 2, 3, 5]))
+        self.assertEqual([4], [x.id for x in Download.objects.all()])
+
+    @mock.patch('sys.stdout')
+    def test_fill_locations(self, stdout):
+        for ip in ('1.1.1.1', '1.1.1.2', '1.1.1.1', '::1', '1.1.1.3'):
+            _create_download(ip, '/foo/bar')
+        Download.objects.filter(ip='1.1.1.3').update(
+            country='XX', region_isp='done')
+
+        locations = {
+            '1.1.1.1': mock.Mock(country_short='AA', region='r', isp='i'),
+            '1.1.1.2': mock.Mock(country_short='AA', region='r', isp='i'),
+        }
+        ipl = mock.Mock()
+        ipl.get_all.side_effect = lambda ip: locations[ip]
+        with mock.patch.object(downloads_report, 'CHUNK_SIZE', 2):
+            Command()._fill_locations(ipl)
+
+        self.assertEqual(
+            ['1.1.1.1', '1.1.1.2', '::1'],
+            sorted(x[0][0] for x in ipl.get_all.call_args_list))
+        self.assertEqual([
+            ('1.1.1.1', 'AA', 'r / i'),
+            ('1.1.1.2', 'AA', 'r / i'),
+            ('1.1.1.1', 'AA', 'r / i'),
+            ('::1', 'ipv6-unknown', 'ipv6-unknown'),
+            ('1.1.1.3', 'XX', 'done'),
+        ], list(Download.objects.order_by('id').values_list(
+            'ip', 'country', 'region_isp')))
+
+    @mock.patch('sys.stdout')
+    def test_fill_locations_concurrent_insert(self, stdout):
+        _create_download('1.1.1.1', '/a')
+        ipl = mock.Mock()
+        ipl.get_all.return_value = mock.Mock(
+            country_short='AA', region='r', isp='i')
+        month_counts = Download.month_counts
+
+        def _month_counts(qs, *columns):
+            # report_process adds a download once the chunk is counted
+            _create_download('1.1.1.1', '/late')
+            return month_counts(qs, *columns)
+
+        with mock.patch.object(Download, 'month_counts',
+                               side_effect=_month_counts):
+            Command()._fill_locations(ipl)
+        self.assertEqual(
+            [('/a', 'AA'), ('/late', None)],
+            list(Download.objects.order_by('id').values_list(
+                'name', 'country')))
+        self.assertEqual(['/a'], list(
+            models.DownloadsByName.objects.values_list('name', flat=True)))
+
+        # and it's counted by the next run
+        Command()._fill_locations(ipl)
+        self.assertEqual(['/a', '/late'], sorted(
+            models.DownloadsByName.objects.values_list('name', flat=True)))
+
+    @mock.patch('sys.stdout')
+    def test_rollups(self, stdout):
+        downloads = [
+            ('1.1.1.1', '/a', datetime.datetime(2018, 2, 10)),
+            ('1.1.1.1', '/a', datetime.datetime(2018, 3, 10)),
+            ('1.1.1.2', '/a', datetime.datetime(2018, 3, 11)),
+            ('1.1.1.2', '/components/b', datetime.datetime(2018, 3, 12)),
+        ]
+        for ip, name, ts in downloads:
+            Download.objects.create(ip=ip, name=name, link=False, timestamp=ts)
+        locations = {
+            '1.1.1.1': mock.Mock(country_short='AA', region='r', isp='i'),
+            '1.1.1.2': mock.Mock(country_short='BB', region='r', isp='i'),
+        }
+        ipl = mock.Mock()
+        ipl.get_all.side_effect = lambda ip: locations[ip]
+
+        def _rollups():
+            return dict((cls.column, sorted(cls.objects.values_list(
+                'month', cls.column, 'builds', 'components')))
+                for cls in models.ROLLUPS)
+
+        expected = {
+            'name': [('2018.02', '/a', 1, 0), ('2018.03', '/a', 2, 0),
+                     ('2018.03', '/components/b', 0, 1)],
+            'country': [('2018.02', 'AA', 1, 0), ('2018.03', 'AA', 1, 0),
+                        ('2018.03', 'BB', 1, 1)],
+            'region_isp': [('2018.02', 'r / i', 1, 0),
+                           ('2018.03', 'r / i', 2, 1)],
+        }
+        with mock.patch.object(downloads_report, 'CHUNK_SIZE', 1):
+            Command()._fill_locations(ipl)
+        self.assertEqual(expected, _rollups())
+
+        # enriched downloads aren't counted again
+        Command()._fill_locations(ipl)
+        self.assertEqual(expected, _rollups())
+
+        models.DownloadsByName.objects.all().delete()
+        models.rebuild_rollups()
+        self.assertEqual(expected, _rollups())
+        self.assertEqual('2018.02', models.first_report_month())
+
+        # the migration that fills the tables when they are created
+        migration = importlib.import_module(
+            'license_protected_downloads.migrations.'
+            '0008_fill_download_rollups')
+        for cls in models.ROLLUPS:
+            cls.objects.all().delete()
+        migration.fill_rollups(apps, None)
+        self.assertEqual(expected, _rollups())
@@ -1,19 +1,28 @@
 __author__ = 'dooferlad'
 
+import csv
 import datetime
+import glob
 import hashlib
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
 
 from django.conf import settings
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from license_protected_downloads import download_events
 
 from license_protected_downloads.models import (
     APIKeyStore,
     APIToken,
     Download,
     License,
+    LicenseRegistry,
 )
 
 
@@ -48,6 +57,52 @@ class LicenseTestCase(TestCase):
         self.assertEquals(lic3.text, 'Linaro License')
 
 
+class LicenseRegistryTests(TransactionTestCase):
+    def setUp(self):
+        self.registry = LicenseRegistry()
+
+    def test_register(self):
+        digest = self.registry.register('text', 'linaro')
+        self.assertEqual(hashlib.md5('text').hexdigest(), digest)
+        self.assertEqual('linaro', License.objects.get(digest=digest).theme)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(digest, self.registry.register('text', 'x'))
+        self.assertEqual(1, License.objects.count())
+
+    def test_warm(self):
+        License.objects.create(digest=hashlib.md5('a').hexdigest(),
+                               text='a', theme='linaro')
+        with self.assertNumQueries(1):
+            self.registry.register('a', 'linaro')
+            self.registry.register('a', 'linaro')
+
+    def test_inserted_by_other_worker(self):
+        self.registry.register('a', 'linaro')
+        License.objects.create(digest=hashlib.md5('b').hexdigest(),
+                               text='b', theme='samsung')
+        digest = self.registry.register('b', 'linaro')
+        self.assertEqual('samsung', License.objects.get(digest=digest).theme)
+
+    def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.registry.register('a', 'linaro')
+                raise RuntimeError()
+        self.assertEqual(0, License.objects.count())
+        self.registry.register('a', 'linaro')
+        self.assertEqual(1, License.objects.count())
+
+    def test_delete(self):
+        digest = self.registry.register('a', 'linaro')
+        with mock.patch(
+                'license_protected_downloads.models.license_registry',
+                self.registry):
+            License.objects.get(digest=digest).delete()
+        self.registry.register('a', 'linaro')
+        self.assertEqual(1, License.objects.count())
+
+
 class APITokenTests(TestCase):
     def setUp(self):
         self.key = APIKeyStore.objects.create(key='foo', public=True)
@@ -98,5 +153,61 @@ class DownloadTests(TestCase):
             self.assertEqual(expected, (ts.year, ts.month, ts.day))
 
 
+@override_settings(DOWNLOAD_QUEUE_SIZE=3, DOWNLOAD_FLUSH_SIZE=100,
+                   DOWNLOAD_FLUSH_INTERVAL=3600)
+class DownloadEventsTests(TestCase):
+    def setUp(self):
+        self.queue = download_events.EventQueue()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.report_csv = os.path.join(self.root, 'report.csv')
+        self.addCleanup(self._stop)
+
+    def _stop(self):
+        with override_settings(REPORT_CSV=self.report_csv):
+            self.queue.stop()
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.root, 'report_*.csv')))
+
+    def test_flush(self):
+        with override_settings(REPORT_CSV=self.report_csv):
+            self.assertEqual(0, self.queue.flush())
+            self.queue.put(['1.2.3.4', '/a', False, '/', 'ts'])
+            self.queue.put(['1.2.3.4', '/b', True, '/', 'ts'])
+            self.assertEqual(2, self.queue.flush())
+            self.queue.put(['1.2.3.4', '/c', False, '/', 'ts'])
+            self.assertEqual(1, self.queue.flush())
+
+        segments = self._segments()
+        self.assertEqual(2, len(segments))
+        rows = [list(csv.reader(open(x))) for x in segments]
+        self.assertEqual([['1.2.3.4', '/a', 'False', '/', 'ts'],
+                          ['1.2.3.4', '/b', 'True', '/', 'ts']], rows[0])
+        self.assertEqual({'queued': 3, 'written': 3, 'flushes': 2,
+                          'waiting': 0}, self.queue.stats())
+
+    def test_dropped_when_full(self):
+        for i in range(5):
+            self.queue.put([i])
+        self.assertEqual({'queued': 3, 'dropped': 2, 'waiting': 3},
+                         self.queue.stats())
+
+    @mock.patch.object(download_events, 'log')
+    def test_failed_flush_kept(self, log):
+        missing = os.path.join(self.root, 'missing', 'report.csv')
+        with override_settings(REPORT_CSV=missing):
+            self.queue.put(['a'])
+            self.assertEqual(0, self.queue.flush())
+        self.assertEqual(1, self.queue.stats()['waiting'])
+        self.assertEqual(1, self.queue.stats()['errors'])
+
+        with override_settings(REPORT_CSV=self.report_csv):
+            self.queue.put(['b'])
+            self.assertEqual(2, self.queue.flush())
+        self.assertEqual([['a'], ['b']],
+                         list(csv.reader(open(self._segments()[0]))))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@ import tempfile
 import shutil
 import re
 from django.conf import settings
+import mock
 from license_protected_downloads.render_text_files import RenderTextFiles
 from license_protected_downloads.render_text_files \
  import MultipleFilesException
@@ -33,6 +34,22 @@ class RenderTextFilesTests(unittest.TestCase):
         self.assertEqual([],
             RenderTextFiles.findall(l, lambda x: re.search(r'1', x)))
 
+    def test_render_buff_cached(self):
+        with mock.patch('textile.textile', return_value='<p>x</p>') as t:
+            buff = 'cached textile %s' % self.id()
+            self.assertEqual('<p>x</p>', RenderTextFiles.render_buff(buff))
+            self.assertEqual('<p>x</p>', RenderTextFiles.render_buff(buff))
+            self.assertEqual(1, t.call_count)
+            RenderTextFiles.render_buff(buff + ' changed')
+            self.assertEqual(2, t.call_count)
+
+    def test_render_buff_failure_cached(self):
+        with mock.patch('textile.textile', side_effect=ValueError) as t:
+            buff = 'broken textile %s' % self.id()
+            self.assertIsNone(RenderTextFiles.render_buff(buff))
+            self.assertIsNone(RenderTextFiles.render_buff(buff))
+            self.assertEqual(1, t.call_count)
+
     def make_temp_dir(self, empty=True, file_list=None, dir=None):
         path = tempfile.mkdtemp(dir=dir)
         if not empty:
@@ -1,17 +1,26 @@
+import httplib
 import os
+import pickle
 import shutil
+import socket
 import tempfile
+import threading
 import unittest
 import urlparse
 
+import boto.exception
+import boto.s3.key
+import boto.s3.prefix
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 import mock
 
 from license_protected_downloads.artifact import Artifact, S3Artifact
-from license_protected_downloads import common
+from license_protected_downloads.artifact import s3
+from license_protected_downloads import common, s3_connection
 from license_protected_downloads.tests.test_views import (
     BuildInfoProtectedTests,
     EulaProtectedTests,
@@ -23,6 +32,12 @@ from license_protected_downloads.tests.test_views import (
 _orig_s3_prefix = getattr(settings, 'S3_PREFIX_PATH', None)
 _s3_enabled = _orig_s3_prefix is not None
 
+_locmem_caches = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 def _upload_sampleroot(bucket):
     # make sure nothing was left from an old run
@@ -203,3 +218,325 @@ class TestMixedBuilds(TestCase):
 
         # s3 folder listings have no "mtime", so we can validate with that:
         self.assertNotEqual('-', listing[1]['mtime'])
+
+
+@override_settings(CACHES=_locmem_caches)
+class TestS3ListingCache(TestCase):
+    '''Tests of the S3 listing cache that don't need a real bucket'''
+    def setUp(self):
+        cache.clear()
+        key = boto.s3.key.Key(None, 'p/file.txt')
+        key.size = 12
+        key.last_modified = '2016-12-16T11:37:00.000Z'
+        key.etag = '"abc"'
+        self.bucket = mock.Mock()
+        self.bucket.list.return_value = [
+            key, boto.s3.prefix.Prefix(None, 'p/dir/')]
+
+    def _check_listing(self, items):
+        self.assertEqual(['p/file.txt', 'p/dir/'], [x.name for x in items])
+        self.assertEqual(12, items[0].size)
+        self.assertEqual('"abc"', items[0].etag)
+        self.assertTrue(isinstance(items[1], boto.s3.prefix.Prefix))
+        self.assertIs(self.bucket, items[0].bucket)
+
+    def test_cached(self):
+        self._check_listing(s3.list_prefix(self.bucket, 'p/'))
+        self._check_listing(s3.list_prefix(self.bucket, 'p/'))
+        self.bucket.list.assert_called_once_with(delimiter='/', prefix='p/')
+
+    def test_fresh_items(self):
+        '''S3Artifact modifies the items it gets, don't share them'''
+        items = s3.list_prefix(self.bucket, 'p/')
+        items[0].last_modified = 0
+        items = s3.list_prefix(self.bucket, 'p/')
+        self.assertEqual('2016-12-16T11:37:00.000Z', items[0].last_modified)
+
+    @override_settings(S3_LISTING_CACHE_MAX_ITEMS=1)
+    def test_large_listing_not_cached(self):
+        s3.list_prefix(self.bucket, 'p/')
+        s3.list_prefix(self.bucket, 'p/')
+        self.assertEqual(2, self.bucket.list.call_count)
+
+    def test_invalidate(self):
+        s3.list_prefix(self.bucket, 'p/')
+        s3.list_prefix(self.bucket, 'p/dir/')
+        s3.list_prefix(self.bucket, 'q/')
+        s3.invalidate_listings('p/dir/sub/new.txt')
+        self.assertEqual(3, self.bucket.list.call_count)
+
+        s3.list_prefix(self.bucket, 'p/')
+        s3.list_prefix(self.bucket, 'p/dir/')
+        s3.list_prefix(self.bucket, 'q/')
+        self.assertEqual(5, self.bucket.list.call_count)
+
+
+@override_settings(CACHES=_locmem_caches, S3_PREFIX_PATH='p/')
+class TestS3Wildcard(TestCase):
+    '''Tests of S3 wildcard matching that don't need a real bucket'''
+    def setUp(self):
+        cache.clear()
+        self.bucket = mock.Mock()
+        self.bucket.list.side_effect = lambda **kw: iter([
+            self._key('p/b.img.gz'), self._key('p/b.txt'),
+            self._key('p/b2.img.gz'), self._key('p/b3.img.gz')])
+
+    def _key(self, name):
+        key = boto.s3.key.Key(None, name)
+        key.size = 1
+        key.last_modified = '2016-12-16T11:37:00.000Z'
+        return key
+
+    def test_narrowed(self):
+        items = s3.match_prefix(self.bucket, 'p/', 'b*.img.gz')
+        self.assertEqual(['p/b.img.gz', 'p/b2.img.gz'],
+                         [x.name for x in items])
+        self.bucket.list.assert_called_once_with(delimiter='/', prefix='p/b')
+
+    def test_cached(self):
+        s3.match_prefix(self.bucket, 'p/', 'b*.img.gz')
+        s3.match_prefix(self.bucket, 'p/', 'b*.img.gz')
+        self.assertEqual(1, self.bucket.list.call_count)
+
+        s3.invalidate_listings('p/b4.img.gz')
+        s3.match_prefix(self.bucket, 'p/', 'b*.img.gz')
+        self.assertEqual(2, self.bucket.list.call_count)
+
+    def test_handle_s3_wildcard(self):
+        request = mock.Mock()
+        a = common._handle_s3_wildcard(request, self.bucket, 'p/b.img*')
+        self.assertEqual('b.img.gz', a.file_name)
+        with self.assertRaises(Http404):
+            common._handle_s3_wildcard(request, self.bucket, 'p/b*.img.gz')
+        self.assertIsNone(
+            common._handle_s3_wildcard(request, self.bucket, 'p/c*'))
+
+
+class TestS3ArtifactPickle(TestCase):
+    @override_settings(S3_PREFIX_PATH='p/')
+    def test_pickle(self):
+        '''artifacts are cached, make sure the bucket isn't pickled'''
+        key = boto.s3.key.Key(None, 'p/file.txt')
+        key.size = 12
+        key.last_modified = '2016-12-16T11:37:00.000Z'
+        with mock.patch.object(S3Artifact, 'get_bucket') as get_bucket:
+            get_bucket.return_value = 'bucket'
+            a = S3Artifact(mock.Mock(), key, None, False)
+            a = pickle.loads(pickle.dumps(a))
+        self.assertEqual('bucket', a.bucket)
+        self.assertEqual('bucket', a.item.bucket)
+        self.assertEqual('p/file.txt', a.item.name)
+        self.assertEqual('/file.txt', a.url())
+
+
+@override_settings(S3_PREFIX_PATH='p/', ANNOTATED_XML='MANIFEST.xml',
+                   ANDROID_FILES=['HOWTO_install.txt'], LINUX_FILES=[])
+class TestS3Prefetch(TestCase):
+    def setUp(self):
+        names = ['p/d/MANIFEST.xml', 'p/d/HOWTO_install.txt', 'p/d/x.img']
+        listing = [(x, 1, '2016-12-16T11:37:00.000Z', 'etag') for x in names]
+        listing.append(('p/d/sub/', None, None, None))
+        mocked = mock.patch.object(s3, '_listing_entries',
+                                   return_value=listing)
+        self.list_entries = mocked.start()
+        self.addCleanup(mocked.stop)
+        mocked = mock.patch.object(s3.s3_connection, 'get_bucket')
+        self.thread_bucket = mocked.start()
+        self.addCleanup(mocked.stop)
+
+        self.reads = []
+
+        def read_key(artifact, name):
+            self.reads.append(name)
+            if name.endswith('HEADER.html'):
+                return None
+            return 'contents of ' + name
+        mocked = mock.patch.object(S3Artifact, '_read_key', read_key)
+        mocked.start()
+        self.addCleanup(mocked.stop)
+
+        self.artifact = S3Artifact(
+            mock.Mock(), boto.s3.prefix.Prefix(None, 'p/d/'), None, False)
+
+    def test_prefetch(self):
+        self.artifact.prefetch()
+        self.assertEqual(
+            sorted(['p/d/BUILD-INFO.txt', 'p/d/HEADER.textile',
+                    'p/d/HEADER.html', 'p/d/MANIFEST.xml',
+                    'p/d/HOWTO_install.txt']),
+            sorted(self.reads))
+
+        self.reads = []
+        self.assertEqual('contents of p/d/BUILD-INFO.txt',
+                         self.artifact.build_info_buffer)
+        self.assertEqual('contents of p/d/HEADER.textile',
+                         self.artifact.get_file_contents('HEADER.textile'))
+        self.assertIsNone(self.artifact.get_file_contents('HEADER.html'))
+        self.assertEqual([], self.reads)
+
+        # the children are added by dir_list()
+        for x in self.artifact.listing('p/d/'):
+            S3Artifact(None, x, self.artifact, False)
+        self.assertEqual('contents of p/d/MANIFEST.xml',
+                         self.artifact.get_annotated_manifest())
+        files = list(self.artifact.get_textile_files())
+        self.assertEqual('p/d/HOWTO_install.txt', files[0][0])
+        self.assertEqual('contents of p/d/HOWTO_install.txt',
+                         files[0][1].read())
+        self.assertEqual([], self.reads)
+        # listed once, with the bucket of the thread listing it
+        self.list_entries.assert_called_once_with(
+            self.thread_bucket.return_value, 'p/d/')
+
+    def test_dir_list_uses_prefetched_listing(self):
+        self.artifact.prefetch()
+        with mock.patch.object(S3Artifact, 'get_bucket',
+                               return_value=self.artifact.bucket):
+            entries = common.dir_list(self.artifact)
+        self.assertEqual(['MANIFEST.xml', 'sub', 'x.img'],
+                         sorted(x['name'] for x in entries))
+        self.assertEqual(1, self.list_entries.call_count)
+
+    def test_not_pickled(self):
+        self.artifact.prefetch()
+        with mock.patch.object(S3Artifact, 'get_bucket'):
+            a = pickle.loads(pickle.dumps(self.artifact))
+        self.assertFalse(hasattr(a, '_prefetched'))
+
+
+@override_settings(S3_BUCKET='bucket', AWS_ACCESS_KEY_ID='id',
+                   AWS_SECRET_ACCESS_KEY='secret', S3_RETRIES=2,
+                   S3_RETRY_BACKOFF=1, S3_HEALTH_CHECK_INTERVAL=60)
+class TestS3ConnectionManager(TestCase):
+    def setUp(self):
+        self.manager = s3_connection.S3ConnectionManager()
+        mocked = mock.patch('boto.connect_s3',
+                            side_effect=lambda *a: mock.Mock())
+        self.connect = mocked.start()
+        self.addCleanup(mocked.stop)
+        mocked = mock.patch.object(s3_connection, 'log')
+        mocked.start()
+        self.addCleanup(mocked.stop)
+
+    def test_per_thread(self):
+        bucket = self.manager.get_bucket()
+        self.assertIs(bucket, self.manager.get_bucket())
+        self.assertIs(bucket, self.manager.get_bucket('bucket'))
+        self.manager.connection().get_bucket.assert_called_once_with(
+            'bucket', validate=False)
+
+        buckets = []
+        t = threading.Thread(
+            target=lambda: buckets.append(self.manager.get_bucket()))
+        t.start()
+        t.join()
+        self.assertIsNot(bucket, buckets[0])
+        self.assertEqual(2, self.connect.call_count)
+
+    @override_settings(S3_BUCKET=None)
+    def test_not_configured(self):
+        self.assertIsNone(self.manager.get_bucket())
+        self.assertFalse(self.connect.called)
+
+    def test_health_check(self):
+        with mock.patch('time.time', return_value=1000):
+            conn = self.manager.connection()
+        with mock.patch('time.time', return_value=1030):
+            self.assertIs(conn, self.manager.connection())
+        self.assertFalse(conn.head_bucket.called)
+
+        with mock.patch('time.time', return_value=1100):
+            self.assertIs(conn, self.manager.connection())
+        conn.head_bucket.assert_called_once_with('bucket')
+
+        conn.head_bucket.side_effect = socket.error()
+        with mock.patch('time.time', return_value=1200):
+            self.assertIsNot(conn, self.manager.connection())
+
+    @mock.patch('time.sleep')
+    def test_retry(self, sleep):
+        func = mock.Mock(side_effect=[httplib.BadStatusLine(''),
+                                      socket.error(), 'ok'])
+        self.assertEqual('ok', self.manager.retry(func, 1, a=2))
+        func.assert_called_with(1, a=2)
+        self.assertEqual([mock.call(1), mock.call(2)], sleep.call_args_list)
+
+        func = mock.Mock(side_effect=httplib.BadStatusLine(''))
+        with self.assertRaises(httplib.BadStatusLine):
+            self.manager.retry(func)
+        self.assertEqual(3, func.call_count)
+
+    @mock.patch('time.sleep')
+    def test_no_retry(self, sleep):
+        err = boto.exception.S3ResponseError(404, 'Not Found')
+        func = mock.Mock(side_effect=err)
+        with self.assertRaises(boto.exception.S3ResponseError):
+            self.manager.retry(func)
+        self.assertEqual(1, func.call_count)
+
+        err = boto.exception.S3ResponseError(503, 'Slow Down')
+        func = mock.Mock(side_effect=[err, 'ok'])
+        self.assertEqual('ok', self.manager.retry(func))
+
+
+@override_settings(CACHES=_locmem_caches, S3_PREFIX_PATH='p/',
+                   LATEST_LINK_LOCAL_TIMEOUT=30)
+class TestS3LatestLinks(TestCase):
+    '''Tests of the .s3_linked_from cache that don't need a real bucket'''
+    def setUp(self):
+        cache.clear()
+        s3._links.clear()
+        self.addCleanup(s3._links.clear)
+        mocked = mock.patch('boto.s3.key.Key.get_contents_as_string')
+        self.read = mocked.start()
+        self.addCleanup(mocked.stop)
+        self.read.return_value = 'p/android/builds/12\n'
+        self.link = 'p/android/builds/latest/.s3_linked_from'
+
+    def test_cached(self):
+        self.assertEqual(
+            'android/builds/12/foo.img',
+            common.s3_replace_latest('android/builds/latest/foo.img', None))
+        self.assertEqual(
+            'android/builds/12/bar.img',
+            common.s3_replace_latest('android/builds/latest/bar.img', None))
+        self.assertEqual(1, self.read.call_count)
+
+        # other processes get it from the django cache
+        s3._links.clear()
+        self.assertEqual('p/android/builds/12', s3.read_link(None, self.link))
+        self.assertEqual(1, self.read.call_count)
+
+    def test_local_timeout(self):
+        with mock.patch('time.time', return_value=1000):
+            s3.read_link(None, self.link)
+        cache.clear()
+        self.read.return_value = 'p/android/builds/13'
+        with mock.patch('time.time', return_value=1020):
+            self.assertEqual(
+                'p/android/builds/12', s3.read_link(None, self.link))
+        with mock.patch('time.time', return_value=1040):
+            self.assertEqual(
+                'p/android/builds/13', s3.read_link(None, self.link))
+
+    def test_missing(self):
+        self.read.side_effect = boto.exception.S3ResponseError(404, 'NoKey')
+        url = 'android/builds/latest/foo.img'
+        self.assertEqual(url, common.s3_replace_latest(url, None))
+        self.assertEqual(url, common.s3_replace_latest(url, None))
+        self.assertEqual(1, self.read.call_count)
+
+    @mock.patch.object(s3, 'log')
+    def test_error_not_cached(self, log):
+        self.read.side_effect = boto.exception.S3ResponseError(403, 'Denied')
+        self.assertIsNone(s3.read_link(None, self.link))
+        self.read.side_effect = None
+        self.assertEqual('p/android/builds/12', s3.read_link(None, self.link))
+        self.assertEqual(2, self.read.call_count)
+
+    def test_invalidate(self):
+        s3.read_link(None, self.link)
+        self.read.return_value = 'p/android/builds/13'
+        s3.invalidate_link(self.link)
+        self.assertEqual('p/android/builds/13', s3.read_link(None, self.link))
+        self.assertEqual(2, self.read.call_count)
@@ -6,21 +6,26 @@ import os
 import unittest
 import urlparse
 import csv
+import glob
 import shutil
 import tempfile
 
 import mock
 
 from django.conf import settings
-from django.test import Client, TestCase, override_settings
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.http import HttpResponse
 from license_protected_downloads.buildinfo import BuildInfo
 from license_protected_downloads.artifact import LocalArtifact
-from license_protected_downloads.artifact.base import _insert_license_into_db
 from license_protected_downloads.config import INTERNAL_HOSTS
-from license_protected_downloads.models import Download
+from license_protected_downloads.models import (
+    Download,
+    DownloadsByCountry,
+    DownloadsByName,
+    license_registry,
+)
 from license_protected_downloads.tests.helpers import temporary_directory
-from license_protected_downloads import views
+from license_protected_downloads import download_events, views
 from django.core.management import call_command
 
 THIS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -241,6 +246,24 @@ class HeaderTests(BaseServeViewTest):
         self.assertEquals(200, resp.status_code)
         self.assertIn('<a href="#tabs-2">Git Descriptions</a>', resp.content)
 
+    def test_render_descriptions_parser(self):
+        buf = ('<?xml version="1.0" encoding="UTF-8"?>\n<manifest>\n'
+               '<project name="a"/>\n<!-- about b -->\n'
+               '<project name="b"><!-- nested --><x name="c"/></project>\n'
+               '<!-- about d --><project name="d"/>\n'
+               '<!-- dangling -->\n</manifest>')
+        with mock.patch.object(views._DescriptionParser, 'CHUNK_SIZE', 7):
+            text = views.render_descriptions(buf)
+        self.assertEqual(
+            '<p><strong>Project:</strong> "b"<br>'
+            '<strong>Description:</strong> "about b"</p>'
+            '<p><strong>Project:</strong> "d"<br>'
+            '<strong>Description:</strong> "about d"</p>', text)
+
+        with mock.patch.object(views, '_DescriptionParser') as parser:
+            self.assertEqual(text, views.render_descriptions(buf))
+        self.assertFalse(parser.called)
+
     def test_get_textile_files(self):
         resp = self.client.get(
             '/get-textile-files?path=~linaro-android/staging-panda/')
@@ -275,10 +298,8 @@ class ViewTests(BaseServeViewTest):
 
         # Insert license information into database
         text = build_info.get("license-text", index)
-        digest = hashlib.md5(text).hexdigest()
         theme = build_info.get("theme", index)
-        _insert_license_into_db(digest, text, theme)
-        return digest
+        return license_registry.register(text, theme)
 
     def test_redirect_to_file_on_accept_license(self):
         target_file = "build-info/linaro-blob.txt"
@@ -565,7 +586,10 @@ class ViewTests(BaseServeViewTest):
         report_csv = os.path.join(tempdir, 'download_report.csv')
         with override_settings(REPORT_CSV=report_csv):
             self._test_get_file('build-info/panda-open.txt', True)
-            for row in csv.reader(open(settings.REPORT_CSV)):
+            download_events.flush()
+            segments = glob.glob(os.path.join(tempdir, '*_seg-*.csv'))
+            self.assertEqual(1, len(segments))
+            for row in csv.reader(open(segments[0])):
                 self.assertEqual('/build-info/panda-open.txt', row[1])
                 self.assertEqual('127.0.0.1', row[0])
                 self.assertEqual('False', row[2])
@@ -581,6 +605,48 @@ class ViewTests(BaseServeViewTest):
         self.assertEqual('/', downloads[0].ref)
 
 
+@mock.patch.object(views, '_check_build_info', return_value=None)
+@mock.patch.object(views, 'render')
+class ReportViewTests(TestCase):
+    '''The report urls only exist with TRACK_DOWNLOAD_STATS, so the views
+       are called directly'''
+    def setUp(self):
+        DownloadsByName.objects.create(
+            month='2018.02', name='/a', builds=3)
+        DownloadsByName.objects.create(
+            month='2018.03', name='/components/b', components=2)
+        DownloadsByCountry.objects.create(
+            month='2018.03', country='AA', builds=1, components=2)
+        DownloadsByCountry.objects.create(
+            month='2018.03', country='BB', builds=5)
+        self.request = RequestFactory().get('/reports/')
+
+    def _args(self, render):
+        return render.call_args[0][2]
+
+    def test_months(self, render, check):
+        views.reports(self.request)
+        months = self._args(render)['months']
+        self.assertEqual(['2018.02', '2018.03'], sorted(months)[:2])
+
+    def test_downloads(self, render, check):
+        self.request.GET = {'by': 'component'}
+        views.reports_month_downloads(self.request, '2018.03')
+        self.assertEqual([('/components/b', 2)], [
+            (x.name, x.count) for x in self._args(render)['downloads']])
+
+        self.request.GET = {}
+        views.reports_month_downloads(self.request, '2018.03')
+        self.assertEqual([], list(self._args(render)['downloads']))
+
+    def test_geo(self, render, check):
+        views.reports_month_country(self.request, '2018.03')
+        self.assertEqual([
+            {'geo': 'BB', 'builds': 5, 'components': 0, 'total': 5},
+            {'geo': 'AA', 'builds': 1, 'components': 2, 'total': 3},
+        ], self._args(render)['downloads'])
+
+
 class HowtoViewTests(BaseServeViewTest):
     def test_no_howtos(self):
         with temporary_directory() as serve_root:
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import importlib
 import logging
 import json
@@ -19,10 +20,17 @@ from django.views.decorators.csrf import csrf_exempt
 
 from buildinfo import IncorrectDataFormatException
 from render_text_files import RenderTextFiles
-from models import License, Download
+from models import (
+    Download,
+    DownloadsByCountry,
+    DownloadsByName,
+    DownloadsByRegion,
+    License,
+    first_report_month,
+)
 import config
 from group_auth_common import GroupAuthError
-import xml.dom.minidom as dom
+import xml.parsers.expat as expat
 
 from license_protected_downloads.common import (
     cached_call,
@@ -31,6 +39,7 @@ from license_protected_downloads.common import (
     s3_replace_latest,
 )
 from license_protected_downloads.api.v1 import file_server_post
+from license_protected_downloads.lru import LRUCache
 
 # Load group auth "plugin" dynamically
 group_auth_modules = [
@@ -182,6 +191,7 @@ def _handle_dir_list(request, artifact):
     else:
         up_dir = None
 
+    artifact.prefetch()
     # must come before call to find_and_render to optimize s3
     dirlist = dir_list(artifact)
     rendered_files = RenderTextFiles.find_and_render(artifact)
@@ -229,7 +239,7 @@ def _check_file_permission(request, artifact, internal):
 
 
 def file_server_get(request, path):
-    artifact = cached_call(path, find_artifact, request, path)
+    artifact = cached_call(request, path, find_artifact, request, path)
     internal = get_client_ip(request) in config.INTERNAL_HOSTS
 
     if not internal:
@@ -243,7 +253,7 @@ def file_server_get(request, path):
                 return resp
 
     if artifact.isdir():
-        return cached_call(path, _handle_dir_list, request, artifact)
+        return cached_call(request, path, _handle_dir_list, request, artifact)
 
     # prevent download of files like BUILD-INFO.txt
     if artifact.hidden():
@@ -270,24 +280,71 @@ def get_textile_files(request):
     return HttpResponse(json.dumps(rendered_files))
 
 
+class _DescriptionParser(object):
+    '''Find the projects of an annotated manifest and their descriptions.
+
+    A description is a comment that comes just before a project among the
+    children of the manifest element.
+    '''
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CommentHandler = self._comment
+        self.depth = 0
+        self.comment = None
+        self.found = []
+
+    def _start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if self.comment is not None:
+                self.found.append((attrs.get('name', ''), self.comment))
+            self.comment = None
+
+    def _end(self, name):
+        self.depth -= 1
+
+    def _comment(self, data):
+        if self.depth == 1:
+            self.comment = data.strip()
+
+    def _flush(self):
+        found, self.found = self.found, []
+        return found
+
+    def parse(self, buf):
+        '''Yield (project name, description) pairs from buf.'''
+        for i in xrange(0, len(buf), self.CHUNK_SIZE):
+            self.parser.Parse(buf[i:i + self.CHUNK_SIZE], False)
+            for x in self._flush():
+                yield x
+        self.parser.Parse('', True)
+        for x in self._flush():
+            yield x
+
+
+# number of rendered manifests to remember
+DESCRIPTIONS_SIZE = 32
+
+_descriptions = LRUCache(DESCRIPTIONS_SIZE)
+
+
 def render_descriptions(buf):
     """
        Extracts project name and its description from annotated source manifest
        and returns html string to include in tab.
     """
-    text = ''
-    line = '<p><strong>Project:</strong> "%s"<br>' \
-           '<strong>Description:</strong> "%s"</p>'
-    xmldoc = dom.parseString(buf)
-    nodes = xmldoc.documentElement.childNodes
-
-    for index, node in enumerate(nodes):
-        if node.nodeType == node.COMMENT_NODE:
-            comment = nodes[index]
-            commentedNode = nodes[index + 2]
-            text += line % (commentedNode.getAttribute('name'),
-                            comment.data.strip())
-
+    key = hashlib.md5(buf).hexdigest()
+    text = _descriptions.get(key)
+    if text is None:
+        line = u'<p><strong>Project:</strong> "%s"<br>' \
+               u'<strong>Description:</strong> "%s"</p>'
+        text = u''.join(
+            line % x for x in _DescriptionParser().parse(buf))
+        _descriptions.set(key, text)
     return text
 
 
@@ -321,8 +378,9 @@ def group_authenticated(group):
 def reports(request):
     # Start with the oldest month we have a download from and build up a list.
     months = []
-    cur = Download.objects.order_by('timestamp')[0].timestamp
     now = datetime.datetime.now()
+    first = first_report_month()
+    cur = datetime.datetime.strptime(first, '%Y.%m') if first else now
 
     while (100 * cur.year) + cur.month < (100 * now.year) + now.month:
         months.append(cur.strftime('%Y.%m'))
@@ -338,13 +396,13 @@ def reports(request):
 
 @group_authenticated('linaro')
 def reports_month_downloads(request, year_month):
-    downloads = Download.report(year_month, 'name')
+    downloads = DownloadsByName.report(year_month)
     if request.GET.get('by', 'build') == 'build':
         label = 'Build'
-        downloads = [x for x in downloads if 'components' not in x['name']]
+        downloads = downloads.filter(components=0)
     else:
         label = 'Component'
-        downloads = [x for x in downloads if 'components' in x['name']]
+        downloads = downloads.filter(builds=0)
 
     args = {
         'label': label,
@@ -365,38 +423,29 @@ def reports_month_file_downloads(request, year_month, name):
 
 
 @group_authenticated('linaro')
-def _geo_report(request, year_month, column, label):
-    downloads = {}
-    # We have to go in 2 passes, the first pass gets the total
-    # the 2nd pass gets total of components (and we can then calculate builds).
-    for x in Download.report(year_month, column):
-        e = downloads.setdefault(
-            x[column],
-            {'geo': x[column], 'components': 0, 'builds': 0})
-        e['total'] = x['count']
-        e['builds'] = x['count']  # in case no components are hit below
-
-    for x in Download.report(year_month, column, name__contains='components'):
-        e = downloads[x[column]]
-        e['components'] = x['count']
-        e['builds'] = e['total'] - x['count']
+def _geo_report(request, year_month, rollup, label):
+    downloads = [{
+        'geo': getattr(x, rollup.column),
+        'components': x.components,
+        'builds': x.builds,
+        'total': x.count,
+    } for x in rollup.report(year_month)]
 
     args = {
-        'column': column,
+        'column': rollup.column,
         'label': label,
         'year_month': year_month,
-        'downloads': sorted(
-            downloads.values(), key=lambda x: x['total'], reverse=True),
+        'downloads': downloads,
     }
     return render(request, 'report_geo.html', args)
 
 
 def reports_month_country(request, year_month):
-    return _geo_report(request, year_month, 'country', 'Country')
+    return _geo_report(request, year_month, DownloadsByCountry, 'Country')
 
 
 def reports_month_region(request, year_month):
-    return _geo_report(request, year_month, 'region_isp', 'Region/ISP')
+    return _geo_report(request, year_month, DownloadsByRegion, 'Region/ISP')
 
 
 @group_authenticated('linaro')
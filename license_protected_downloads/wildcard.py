@@ -0,0 +1,65 @@
+'''Resolve the wildcards ("*.img.gz") used in download URLs.
+
+A wildcard URL must match exactly one file, so callers only ever need the
+first two matches to tell a unique match from an ambiguous one.
+'''
+import fnmatch
+import os
+import re
+
+from license_protected_downloads import dir_index
+from license_protected_downloads.lru import LRUCache
+
+# number of compiled patterns to remember
+PATTERNS_SIZE = 256
+
+_patterns = LRUCache(PATTERNS_SIZE)
+
+_WILDCARD = re.compile(r'[*?[]')
+
+
+def literal_prefix(pattern):
+    '''Return the part of pattern before its first wildcard.'''
+    m = _WILDCARD.search(pattern)
+    if m:
+        return pattern[:m.start()]
+    return pattern
+
+
+def compile_pattern(pattern):
+    '''Return a compiled regex equivalent to fnmatch.fnmatch(x, pattern).'''
+    regex = _patterns.get(pattern)
+    if regex is None:
+        regex = re.compile(fnmatch.translate(os.path.normcase(pattern)))
+        _patterns.set(pattern, regex)
+    return regex
+
+
+def first_matches(names, pattern, limit=2, key=None):
+    '''Return the first limit items of names that match pattern.
+
+    key gives the name to match for each item, names are skipped quickly
+    when they don't start with the pattern's literal prefix.
+    '''
+    literal = os.path.normcase(literal_prefix(pattern))
+    match = compile_pattern(pattern).match
+    found = []
+    for item in names:
+        name = os.path.normcase(key(item) if key else item)
+        if name.startswith(literal) and match(name):
+            found.append(item)
+            if len(found) == limit:
+                break
+    return found
+
+
+def match_dir(path, pattern, limit=2):
+    '''Return up to limit names in the directory path that match pattern.
+
+    The result is remembered along with the directory's index.
+    '''
+    index = dir_index.get(path)
+    if index is None:
+        return []
+    return index.cached(('match', pattern, limit), first_matches,
+                        index.names, pattern, limit)
@@ -198,6 +198,57 @@ CACHES = {
     }
 }
 
+# Per-function timeouts for common.cached_call. Functions not listed here use
+# the cache's default timeout. Http404 results are cached for a shorter time.
+CACHE_TIMEOUTS = {
+    'find_artifact': 5 * 60,
+    '_handle_dir_list': 60,
+}
+CACHE_NEGATIVE_TIMEOUT = 30
+
+# S3 directory listings are kept in the default cache for this many seconds.
+# Listings with more entries than S3_LISTING_CACHE_MAX_ITEMS are never cached
+# so a few huge directories can't push everything else out of the cache.
+S3_LISTING_CACHE_TIMEOUT = 5 * 60
+S3_LISTING_CACHE_MAX_ITEMS = 5000
+
+# Number of threads used to fetch the files an S3 directory page needs
+# (headers, textile files, ...) concurrently.
+S3_PREFETCH_THREADS = 8
+
+# S3 requests failing with transient errors are retried S3_RETRIES times,
+# waiting S3_RETRY_BACKOFF seconds before the first retry and doubling that
+# each time. A connection is checked again when it is used more than
+# S3_HEALTH_CHECK_INTERVAL seconds after its last check.
+S3_RETRIES = 3
+S3_RETRY_BACKOFF = 0.5
+S3_HEALTH_CHECK_INTERVAL = 5 * 60
+
+# Where "latest" links point, read from their .s3_linked_from files, is kept
+# in each process for LATEST_LINK_LOCAL_TIMEOUT seconds and in the default
+# cache for LATEST_LINK_CACHE_TIMEOUT seconds.
+LATEST_LINK_LOCAL_TIMEOUT = 30
+LATEST_LINK_CACHE_TIMEOUT = 5 * 60
+
+# The names and stat info of the entries in local directories are kept in
+# each process until the directory's mtime changes, or for at most this many
+# seconds so that files changed in place are noticed.
+LOCAL_INDEX_TIMEOUT = 60
+
+# Downloads are queued in each process and written to segment files next to
+# REPORT_CSV every DOWNLOAD_FLUSH_INTERVAL seconds, or sooner once
+# DOWNLOAD_FLUSH_SIZE are waiting. Beyond DOWNLOAD_QUEUE_SIZE waiting
+# downloads, new ones are dropped.
+DOWNLOAD_FLUSH_INTERVAL = 5
+DOWNLOAD_FLUSH_SIZE = 500
+DOWNLOAD_QUEUE_SIZE = 10000
+
+# downloads_archive moves the downloads of months older than
+# DOWNLOAD_ARCHIVE_KEEP_MONTHS out of the database into gzipped CSV files
+# in DOWNLOAD_ARCHIVE_DIR. Their counts stay in the monthly report tables.
+DOWNLOAD_ARCHIVE_DIR = os.path.join(DEPLOYMENT_DIR, 'download_archive')
+DOWNLOAD_ARCHIVE_KEEP_MONTHS = 12
+
 import django
 if django.VERSION < (1, 6):
     # old django needs a hack to not send emails for ALLOWED_HOSTS violations